@@ -0,0 +1,183 @@
+"""Benchmarks the geometry stages on the example organigrams
+
+Every page is extracted and analysed several times and the fastest run of
+each stage is kept:
+  - pdf_extract_drawing (pdf.extract_drawing),
+  - document_extract (Document.extract) and its parts
+    document_extract_nodes, document_extract_text_blocks and
+    document_generate_text.
+
+The stages of Document.extract are taken from the spans of the telemetry
+tracer, so the benchmark measures the same code as a profiled run. The
+primitive counts of every page (rects, lines, text spans, text blocks) are
+recorded as well, since a change of those explains a change of the time.
+
+    python benchmarks/geometry.py --save-baseline
+    python benchmarks/geometry.py --threshold 0.2
+
+The results are compared with the baseline (benchmarks/baseline.json by
+default) and the benchmark fails if the total time of a stage regresses by
+more than threshold or a primitive count changes. Timings depend on the
+machine, so the baseline has to be recorded on the machine running the
+comparison.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import pymupdf
+
+from orgxtract import Document
+import orgxtract.pdf as pdf
+import orgxtract.telemetry as telemetry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, "example_orgcharts")
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+STAGES = [
+    "pdf_extract_drawing",
+    "document_extract",
+    "document_extract_nodes",
+    "document_extract_text_blocks",
+    "document_generate_text",
+]
+
+# Stages faster than this (seconds) in total are too noisy to be compared.
+MIN_COMPARED_SECONDS = 0.005
+
+def benchmark_page(page: pymupdf.Page, repeat: int) -> dict:
+    """Returns the fastest time (seconds) of every stage and the counts of the page"""
+
+    times = {stage:float("inf") for stage in STAGES}
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        drawing = pdf.extract_drawing(page)
+        times["pdf_extract_drawing"] = min(times["pdf_extract_drawing"],
+                                           time.perf_counter() - start)
+
+    for _ in range(repeat):
+        tracer = telemetry.start_tracing()
+
+        try:
+            document = Document.extract(drawing)
+        finally:
+            telemetry.stop_tracing()
+
+        for event in tracer.events:
+            if event["ph"] == "X" and event["name"] in times:
+                times[event["name"]] = min(times[event["name"]], event["dur"] / 1e6)
+
+    counts = {
+        "rects": len(drawing.rects),
+        "lines": len(drawing.lines),
+        "text_spans": len(drawing.text_spans),
+        "detected_rects": len(document.rects),
+        "text_blocks": len(document.text_blocks),
+    }
+
+    return {"seconds": times, "counts": counts}
+
+def run(paths: list[str], repeat: int) -> dict:
+    pages = {}
+
+    for path in paths:
+        name = os.path.relpath(path, ROOT)
+
+        with pymupdf.open(path, filetype="pdf") as document:
+            for index in range(document.page_count):
+                pages[f"{name}#{index}"] = benchmark_page(document[index], repeat)
+                print(f"{name}#{index}", format_seconds(pages[f"{name}#{index}"]["seconds"]),
+                      file=sys.stderr)
+
+    totals = {stage:sum(page["seconds"][stage] for page in pages.values()) for stage in STAGES}
+
+    return {"repeat": repeat, "totals": totals, "pages": pages}
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Returns the regressions of results against the baseline"""
+
+    regressions = []
+
+    for stage in STAGES:
+        before = baseline["totals"].get(stage)
+        after = results["totals"][stage]
+
+        if before == None or max(before, after) < MIN_COMPARED_SECONDS:
+            continue
+
+        change = after / before - 1.0 if 0.0 < before else 0.0
+        print(f"{stage:30} {before * 1e3:10.2f} ms -> {after * 1e3:10.2f} ms ({change:+.1%})")
+
+        if threshold < change:
+            regressions.append(f"{stage} is {change:.1%} slower")
+
+    for (page, result) in results["pages"].items():
+        counts = baseline["pages"].get(page, {}).get("counts")
+
+        if counts != None and counts != result["counts"]:
+            regressions.append(f"{page} counts changed from {counts} to {result['counts']}")
+
+    return regressions
+
+def format_seconds(seconds: dict) -> str:
+    return " ".join(f"{stage}={value * 1e3:.2f}ms" for (stage, value) in seconds.items())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths",
+                        help="PDFs to benchmark (default: example_orgcharts)",
+                        nargs="*")
+    parser.add_argument("-n", "--repeat",
+                        help="runs of each stage per page, the fastest is kept",
+                        type=int,
+                        default=5)
+    parser.add_argument("-b", "--baseline",
+                        help="baseline file",
+                        default=BASELINE)
+    parser.add_argument("--save-baseline",
+                        help="write the results as new baseline instead of comparing",
+                        action="store_true")
+    parser.add_argument("-t", "--threshold",
+                        help="relative slowdown of a stage considered a regression",
+                        type=float,
+                        default=0.2)
+    parser.add_argument("-o", "--output",
+                        help="file to write the results to")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(os.path.join(EXAMPLES, name)
+                                 for name in os.listdir(EXAMPLES)
+                                 if name.endswith(".pdf"))
+    results = run(paths, args.repeat)
+
+    if args.output != None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+        return
+
+    if not os.path.exists(args.baseline):
+        sys.exit(f"No baseline at {args.baseline}, record one with --save-baseline")
+
+    with open(args.baseline, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+
+    regressions = compare(results, baseline, args.threshold)
+
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+
+    sys.exit(1 if 0 < len(regressions) else 0)
+
+if __name__ == "__main__":
+    main()
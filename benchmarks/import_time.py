@@ -0,0 +1,75 @@
+"""Checks that the geometry-only API and the CLI start within a budget
+
+The modules are imported in a fresh interpreter with -X importtime, which
+lists the slowest modules. The check fails if importing takes longer than
+the budget or if one of
+the heavy subsystems (spaCy, llm) is imported although it is not used.
+
+    python benchmarks/import_time.py --budget 0.5
+"""
+
+import argparse
+import subprocess
+import sys
+
+# Modules only the text pipeline may import
+HEAVY_MODULES = ["spacy", "llm", "fix_busted_json", "thinc", "torch"]
+
+def measure(modules: list[str]) -> tuple[float, dict[str, int], set[str]]:
+    """Returns the total import time, the cumulative import time (µs) of each
+    module and all modules imported"""
+
+    code = "import sys, time;start = time.perf_counter();"
+    code += ";".join(f"import {module}" for module in modules)
+    code += ";print(time.perf_counter() - start);print('\\n'.join(sys.modules))"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             capture_output=True, text=True)
+
+    if process.returncode != 0:
+        sys.exit(process.stderr.splitlines()[-1])
+
+    (total, *imported) = process.stdout.split()
+    times = {}
+
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        (_, cumulative, name) = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+
+    return (float(total), times, set(imported))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget",
+                        help="max import time in seconds",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--modules",
+                        help="modules to import",
+                        nargs="+",
+                        default=["orgxtract", "orgxtract.pdf", "orgxtract.cli"])
+    args = parser.parse_args()
+
+    (total, times, imported) = measure(args.modules)
+
+    for (name, micros) in sorted(times.items(), key=lambda item: -item[1])[:10]:
+        print(f"{micros / 1e3:10.1f} ms  {name}")
+
+    print(f"{total * 1e3:10.1f} ms  total (budget {args.budget * 1e3:.0f} ms)")
+
+    heavy = sorted(module for module in HEAVY_MODULES if module in imported)
+    is_ok = total <= args.budget
+
+    if not is_ok:
+        print("Import time exceeds the budget", file=sys.stderr)
+
+    if 0 < len(heavy):
+        print(f"Heavy modules imported: {', '.join(heavy)}", file=sys.stderr)
+        is_ok = False
+
+    sys.exit(0 if is_ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""Generates synthetic organigrams of any size with their ground truth
+
+The organigram is a tree of boxes, every box connected to its parent by a
+connector. The parameters cover the variants the
+geometry has to deal with:
+  - boxes: the amount of boxes and depth: the amount of levels,
+  - lines: boxes are drawn as four line segments instead of a rectangle,
+  - gap: the segments of a box end gap points before the corners, which
+    requires Document.extract with a tolerance of at least gap,
+  - dashed: connectors are drawn as short segments with gaps between them,
+    like dashed lines of some PDF generators, which multiplies the lines,
+  - text_density: the average amount of text lines in a box.
+
+Next to the PDF a JSON file with the ground truth is written: the rect,
+parent, level and text of every box. With --check the PDF is extracted
+again and compared with the ground truth, and --scale sweeps the amount of
+boxes to draw the scaling curve of every stage.
+
+    python benchmarks/synthetic.py out/chart.pdf --boxes 10000 --lines --gap 0.5 --check
+    python benchmarks/synthetic.py out/chart.pdf --scale 1000 2000 5000 10000 20000
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+from typing import NamedTuple
+
+import pymupdf
+
+from orgxtract import Document
+import orgxtract.pdf as pdf
+import orgxtract.telemetry as telemetry
+
+BOX_WIDTH = 90.0
+BOX_HEIGHT = 36.0
+SPACING_X = 14.0
+SPACING_Y = 22.0
+INDENT = 24.0
+MARGIN = 20.0
+FONT_SIZE = 6.0
+LINE_HEIGHT = 8.0
+# Length of the segments and gaps of dashed connectors
+DASH = 2.0
+
+TYPES = ["Abteilung", "Referat", "Unterabteilung", "Stabsstelle", "Büro", "Fachbereich"]
+WORDS = ["Haushalt", "Personal", "Recht", "Steuern", "Zoll", "Grundsatz", "Planung",
+         "Controlling", "Organisation", "Digitalisierung", "Beschaffung", "Presse"]
+NAMES = ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker"]
+POSITIONS = ["MR", "MD", "RD", "ORR", "N.N."]
+
+STAGES = ["pdf_extract_drawing", "document_extract_nodes",
+          "document_extract_text_blocks", "document_generate_text"]
+
+class Options(NamedTuple):
+    boxes: int = 1000
+    depth: int = 4
+    lines: bool = False
+    gap: float = 0.0
+    dashed: bool = False
+    text_density: float = 2.0
+    seed: int = 0
+
+DEFAULTS = Options()
+
+def dashes(p0: tuple[float, float], p1: tuple[float, float]) -> list[tuple]:
+    """Returns the segments of a dashed line from p0 to p1"""
+
+    length = math.dist(p0, p1)
+    segments = []
+    offset = 0.0
+
+    while offset < length:
+        end = min(offset + DASH, length)
+        segments.append((point_at(p0, p1, offset / length), point_at(p0, p1, end / length)))
+        offset = end + DASH
+
+    return segments
+
+def point_at(p0: tuple[float, float], p1: tuple[float, float], t: float) -> tuple[float, float]:
+    return (p0[0] + (p1[0] - p0[0]) * t, p0[1] + (p1[1] - p0[1]) * t)
+
+def build_tree(options: Options) -> list[list[int]]:
+    """Returns the parent of every box on every level
+
+    The branching factor is chosen so that the levels add up to the amount
+    of boxes, the last level takes the remaining boxes.
+    """
+
+    depth = max(1, min(options.depth, options.boxes))
+    branching = max(1.0, (options.boxes - 1) ** (1.0 / max(1, depth - 1)))
+    levels = [[-1]]
+    count = 1
+
+    for level in range(1, depth):
+        parents = len(levels[-1])
+        size = round(branching ** level) if level < depth - 1 else options.boxes - count
+        size = max(1, min(size, options.boxes - count - (depth - 1 - level)))
+        offset = count - parents
+        # Children are spread evenly across the parents of the level above.
+        levels.append([offset + i * parents // size for i in range(size)])
+        count += size
+
+    return levels
+
+def generate_text(rng: random.Random, options: Options) -> list[str]:
+    count = min(3, int(options.text_density) + (rng.random() < options.text_density % 1))
+    lines = []
+
+    for index in range(count):
+        if index == 0:
+            lines.append(f"{rng.choice(TYPES)} {rng.randint(1, 99)}")
+        elif index == 1:
+            lines.append(rng.choice(WORDS))
+        else:
+            lines.append(f"{rng.choice(POSITIONS)} {rng.choice(NAMES)}")
+
+    return lines
+
+def generate(path: str, options: Options) -> dict:
+    """Writes the organigram to path and returns its ground truth
+
+    Large organigrams are drawn as indented trees like the lists of units
+    under a department: the children of a box are stacked below it, indented
+    by one level and connected by a vertical line left of them with a short
+    horizontal line to every child. The boxes are wrapped into columns, so
+    the page stays roughly square. No connector crosses a box.
+    """
+
+    rng = random.Random(options.seed)
+    levels = build_tree(options)
+    children: dict[int, list[int]] = {}
+    parents = [parent for level in levels for parent in level]
+
+    for (box, parent) in enumerate(parents):
+        children.setdefault(parent, []).append(box)
+
+    # Depth first order, which places every subtree below its root
+    order = []
+    stack = [0]
+
+    while 0 < len(stack):
+        box = stack.pop()
+        order.append(box)
+        stack.extend(reversed(children.get(box, [])))
+
+    depth = len(levels)
+    row_height = BOX_HEIGHT + SPACING_Y
+    column_width = (depth - 1) * INDENT + BOX_WIDTH + SPACING_X
+    rows = max(1, math.ceil(math.sqrt(len(order) * column_width / row_height)))
+    columns = math.ceil(len(order) / rows)
+    width = 2 * MARGIN + columns * column_width
+    height = 2 * MARGIN + rows * row_height
+
+    level_of = [level for (level, boxes) in enumerate(levels) for _ in boxes]
+    rects = [None] * len(order)
+    columns_of = [0] * len(order)
+
+    for (position, box) in enumerate(order):
+        (column, row) = divmod(position, rows)
+        columns_of[box] = column
+        x = MARGIN + column * column_width + level_of[box] * INDENT
+        y = MARGIN + row * row_height
+        rects[box] = (x, y, x + BOX_WIDTH, y + BOX_HEIGHT)
+
+    document = pymupdf.open()
+    page = document.new_page(width=width, height=height)
+    shape = page.new_shape()
+    connectors = 0
+
+    for rect in rects:
+        (x0, y0, x1, y1) = rect
+
+        if options.lines:
+            g = options.gap
+            shape.draw_line((x0 + g, y0), (x1 - g, y0))
+            shape.draw_line((x1, y0 + g), (x1, y1 - g))
+            shape.draw_line((x1 - g, y1), (x0 + g, y1))
+            shape.draw_line((x0, y1 - g), (x0, y0 + g))
+        else:
+            shape.draw_rect(pymupdf.Rect(x0, y0, x1, y1))
+
+        shape.finish(color=(0, 0, 0), width=0.5)
+
+    for (parent, boxes) in children.items():
+        if parent < 0:
+            continue
+
+        (px0, _, _, top) = rects[parent]
+        previous = parent
+
+        # A vertical line left of the children runs from the parent (or the
+        # previous child) to a horizontal line into each child.
+        for box in boxes:
+            (x0, y0, _, y1) = rects[box]
+            middle = (y0 + y1) / 2
+
+            # Children wrapped into the next column start at its top.
+            if columns_of[previous] != columns_of[box]:
+                top = y0 - SPACING_Y / 2
+
+            points = [(x0 - INDENT / 2, top), (x0 - INDENT / 2, middle), (x0, middle)]
+
+            if options.dashed:
+                for (p0, p1) in zip(points, points[1:]):
+                    for (d0, d1) in dashes(p0, p1):
+                        shape.draw_line(d0, d1)
+            else:
+                shape.draw_polyline(points)
+
+            shape.finish(color=(0.3, 0.3, 0.3), width=0.5, closePath=False)
+            connectors += 1
+            top = middle
+            previous = box
+
+    shape.commit()
+
+    # A single text writer, since every page.insert_text rewrites the page.
+    writer = pymupdf.TextWriter(page.rect)
+    font = pymupdf.Font("helv")
+    texts = []
+
+    for rect in rects:
+        lines = generate_text(rng, options)
+        texts.append("\n".join(lines))
+
+        for (index, line) in enumerate(lines):
+            writer.append((rect[0] + 4, rect[1] + 4 + FONT_SIZE + index * LINE_HEIGHT), line,
+                          font=font, fontsize=FONT_SIZE)
+
+    writer.write_text(page)
+
+    document.save(path, garbage=3, deflate=True)
+    document.close()
+
+    return {
+        "options": options._asdict(),
+        "width": width,
+        "height": height,
+        "connectors": connectors,
+        "boxes": [{"id": box, "level": level_of[box], "parent": parents[box],
+                   "rect": [round(value, 2) for value in rects[box]], "text": texts[box]}
+                  for box in range(len(rects))],
+    }
+
+def check(path: str, truth: dict, tolerance: float) -> dict:
+    """Extracts the organigram and compares it with the ground truth
+
+    Returns the time of every stage (seconds), the share of boxes detected
+    and of boxes whose text is extracted exactly.
+    """
+
+    tracer = telemetry.start_tracing()
+
+    try:
+        with pymupdf.open(path, filetype="pdf") as source:
+            drawing = pdf.extract_drawing(source[0])
+
+        document = Document.extract(drawing, tolerance=tolerance)
+    finally:
+        telemetry.stop_tracing()
+
+    seconds = {stage:0.0 for stage in STAGES}
+
+    for event in tracer.events:
+        if event["ph"] == "X" and event["name"] in seconds:
+            seconds[event["name"]] += event["dur"] / 1e6
+
+    def key(rect) -> tuple:
+        return tuple(round(value) for value in rect)
+
+    detected = {key(rect):index for (index, rect) in enumerate(document.rects)}
+    found = 0
+    text_matches = 0
+
+    for box in truth["boxes"]:
+        index = detected.get(key(box["rect"]))
+
+        if index == None:
+            continue
+
+        found += 1
+
+        if document.text_contents.get(index, "") == box["text"]:
+            text_matches += 1
+
+    count = len(truth["boxes"])
+
+    return {
+        "boxes": count,
+        "seconds": seconds,
+        "detected": found / count,
+        "text": text_matches / count,
+        "lines": len(document.lines),
+        "rects": len(document.rects),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output",
+                        help="path of the PDF, the ground truth is written next to it as .json")
+    parser.add_argument("-n", "--boxes", type=int, default=DEFAULTS.boxes)
+    parser.add_argument("--depth", type=int, default=DEFAULTS.depth)
+    parser.add_argument("--lines",
+                        help="draw boxes as four line segments instead of rectangles",
+                        action="store_true")
+    parser.add_argument("--gap",
+                        help="gap between the line segments at the corners of a box",
+                        type=float,
+                        default=DEFAULTS.gap)
+    parser.add_argument("--dashed",
+                        help="draw connectors as short dashes, one line each",
+                        action="store_true")
+    parser.add_argument("--text-density",
+                        help="average amount of text lines in a box (0 to 3)",
+                        type=float,
+                        default=DEFAULTS.text_density)
+    parser.add_argument("--seed", type=int, default=DEFAULTS.seed)
+    parser.add_argument("--check",
+                        help="extract the PDF and compare it with the ground truth",
+                        action="store_true")
+    parser.add_argument("--tolerance",
+                        help="tolerance of Document.extract (default: gap, at least 1)",
+                        type=float)
+    parser.add_argument("--scale",
+                        help="generate and check organigrams of these amounts of boxes",
+                        type=int,
+                        nargs="+")
+    args = parser.parse_args()
+
+    options = Options(args.boxes, args.depth, args.lines, args.gap, args.dashed,
+                      args.text_density, args.seed)
+    tolerance = args.tolerance if args.tolerance != None else max(1.0, args.gap)
+    directory = os.path.dirname(args.output)
+
+    if 0 < len(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    if args.scale != None:
+        (name, extension) = os.path.splitext(args.output)
+        print("boxes," + ",".join(STAGES) + ",detected,text")
+
+        for boxes in args.scale:
+            path = f"{name}_{boxes}{extension}"
+            truth = generate(path, options._replace(boxes=boxes))
+            result = check(path, truth, tolerance)
+            seconds = ",".join(f"{result['seconds'][stage]:.4f}" for stage in STAGES)
+            print(f"{boxes},{seconds},{result['detected']:.3f},{result['text']:.3f}", flush=True)
+
+        return
+
+    truth = generate(args.output, options)
+
+    with open(os.path.splitext(args.output)[0] + ".json", "w", encoding="utf-8") as file:
+        json.dump(truth, file, ensure_ascii=False)
+
+    if args.check:
+        result = check(args.output, truth, tolerance)
+        print(json.dumps(result, indent=2))
+
+        if result["detected"] < 1.0:
+            sys.exit("Not all boxes were detected")
+
+if __name__ == "__main__":
+    main()
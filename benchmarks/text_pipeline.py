@@ -0,0 +1,190 @@
+"""Benchmarks the spaCy stage of the text pipeline on a fixed corpus
+
+The corpus consists of the text contents of all pages of the example
+organigrams, i.e. exactly the texts the CLI passes to TextPipeline. It is
+piped through the spaCy pipeline of TextPipeline (without LLM) for every
+combination of amount of processes and batch size, and the throughput
+(docs/sec) of each run is reported.
+
+Single process runs also report the time of every component and how often
+token_normalizer and line_break_resolver changed the tokens of a doc, which
+runs the doc through the whole pipeline a second time. The time of such a
+second pass is part of the time of the component triggering it as well as
+of the components it runs. The components of worker processes cannot report
+to the metrics of the benchmark, which is why runs with several processes
+report the throughput only.
+
+    python benchmarks/text_pipeline.py --processes 1 2 4 --batch-sizes 16 64 256
+    python benchmarks/text_pipeline.py --write-corpus corpus.json
+    python benchmarks/text_pipeline.py --corpus corpus.json -o results.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import pymupdf
+
+from orgxtract import Document, TextPipeline
+import orgxtract.pdf as pdf
+from orgxtract.telemetry import metrics
+from orgxtract.text_pipeline import instrument_components, uninstrument_components
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, "example_orgcharts")
+
+RERUNS = ["token_normalizer_reruns_total", "line_break_resolver_reruns_total"]
+
+def collect_corpus(paths: list[str]) -> list[str]:
+    """Returns the text contents of every page in the order of the CLI"""
+
+    corpus = []
+
+    for path in paths:
+        with pymupdf.open(path, filetype="pdf") as document:
+            for page in document:
+                drawing = pdf.extract_drawing(page)
+                corpus.extend(Document.extract(drawing).text_contents.values())
+
+    return corpus
+
+def benchmark(nlp, corpus: list[str], n_process: int, batch_size: int, repeat: int) -> dict:
+    """Returns the throughput of the fastest run and its component times"""
+
+    is_instrumented = n_process == 1
+
+    if is_instrumented:
+        instrument_components(nlp)
+
+    try:
+        best = None
+
+        for _ in range(repeat):
+            metrics.reset()
+            start = time.perf_counter()
+
+            for _doc in nlp.pipe(corpus, n_process=n_process, batch_size=batch_size):
+                pass
+
+            seconds = time.perf_counter() - start
+
+            if best == None or seconds < best["seconds"]:
+                best = {"seconds": seconds, "snapshot": metrics.snapshot()}
+    finally:
+        uninstrument_components(nlp)
+
+    result = {
+        "n_process": n_process,
+        "batch_size": batch_size,
+        "seconds": best["seconds"],
+        "docs_per_second": len(corpus) / best["seconds"],
+    }
+
+    if is_instrumented:
+        histograms = best["snapshot"]["histograms"]
+        counters = best["snapshot"]["counters"]
+        result["components"] = {name:histograms[f"spacy_{name}_seconds"]["sum"]
+                                for name in nlp.pipe_names
+                                if f"spacy_{name}_seconds" in histograms}
+        result["reruns"] = {name.removesuffix("_reruns_total"):counters.get(name, 0)
+                            for name in RERUNS}
+
+    return result
+
+def benchmark_tokenizer(nlp, corpus: list[str], repeat: int) -> float:
+    # The tokenizer is not a component of the pipeline.
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for _doc in nlp.tokenizer.pipe(corpus):
+            pass
+
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def format_result(result: dict, docs: int) -> str:
+    line = (f"n_process={result['n_process']:<2} batch_size={result['batch_size']:<5}"
+            f" {result['docs_per_second']:8.1f} docs/s")
+
+    if "components" in result:
+        components = " ".join(f"{name}={seconds * 1e3:.1f}ms"
+                              for (name, seconds) in result["components"].items())
+        reruns = " ".join(f"{name}={count / docs:.1%}"
+                          for (name, count) in result["reruns"].items())
+        line += f"\n    {components}\n    reruns: {reruns}"
+
+    return line
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths",
+                        help="PDFs to take the corpus from (default: example_orgcharts)",
+                        nargs="*")
+    parser.add_argument("--corpus",
+                        help="JSON file with the list of texts to use instead of PDFs")
+    parser.add_argument("--write-corpus",
+                        help="write the corpus as JSON to this file and exit")
+    parser.add_argument("-p", "--processes",
+                        help="amounts of processes of nlp.pipe to benchmark",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2])
+    parser.add_argument("-b", "--batch-sizes",
+                        help="batch sizes of nlp.pipe to benchmark",
+                        type=int,
+                        nargs="+",
+                        default=[16, 64, 256])
+    parser.add_argument("-n", "--repeat",
+                        help="runs of each variant, the fastest is kept",
+                        type=int,
+                        default=3)
+    parser.add_argument("-o", "--output",
+                        help="file to write the results to")
+    args = parser.parse_args()
+
+    if args.corpus != None:
+        with open(args.corpus, "r", encoding="utf-8") as file:
+            corpus = json.load(file)
+    else:
+        paths = args.paths or sorted(os.path.join(EXAMPLES, name)
+                                     for name in os.listdir(EXAMPLES)
+                                     if name.endswith(".pdf"))
+        corpus = collect_corpus(paths)
+
+    if args.write_corpus != None:
+        with open(args.write_corpus, "w", encoding="utf-8") as file:
+            json.dump(corpus, file, ensure_ascii=False, indent=0)
+
+        print(f"Corpus of {len(corpus)} texts written to {args.write_corpus}", file=sys.stderr)
+        return
+
+    characters = sum(map(len, corpus))
+    print(f"Corpus: {len(corpus)} texts, {characters} characters", file=sys.stderr)
+
+    with TextPipeline() as pipeline:
+        nlp = pipeline.nlp
+        # Warms up the vocabulary and the caches of the model.
+        list(nlp.pipe(corpus[:64]))
+
+        tokenizer = benchmark_tokenizer(nlp, corpus, args.repeat)
+        print(f"tokenizer {tokenizer * 1e3:.1f}ms", file=sys.stderr)
+        results = []
+
+        for n_process in args.processes:
+            for batch_size in args.batch_sizes:
+                result = benchmark(nlp, corpus, n_process, batch_size, args.repeat)
+                results.append(result)
+                print(format_result(result, len(corpus)), file=sys.stderr)
+
+    if args.output != None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"docs": len(corpus), "characters": characters,
+                       "tokenizer_seconds": tokenizer, "runs": results}, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,16 @@
 from orgxtract.drawing import Drawing
 from orgxtract.document import Document
-from orgxtract.text_pipeline import TextPipeline
\ No newline at end of file
+
+__all__ = ["Document", "Drawing", "TextPipeline"]
+
+def __getattr__(name: str):
+    # The text pipeline loads spaCy and llm, which takes seconds. It is only
+    # imported once it is used, so geometry-only callers start quickly.
+    if name == "TextPipeline":
+        from orgxtract.text_pipeline import TextPipeline
+        return TextPipeline
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + ["TextPipeline"])
@@ -1,25 +1,556 @@
 import argparse
-from concurrent.futures import Executor, ThreadPoolExecutor
+import contextlib
+import cProfile
+from concurrent.futures import (Executor, Future, InvalidStateError, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+import copy
+from dataclasses import dataclass, field
 import errno
 import json
 import logging
+import multiprocessing
 import os
-from queue import SimpleQueue, Queue
+from queue import Empty, Full, SimpleQueue, Queue
 import sys
-from typing import Iterator, Optional
+from threading import Condition, Event, Lock
+from typing import Any, Callable, Iterator, Optional
 
-from orgxtract import Document, Drawing, TextPipeline
-import orgxtract.pdf as pdf
+from orgxtract.document import Document
+from orgxtract.drawing import Drawing
+from orgxtract.corpus import Shard, discover
+from orgxtract.deadline import Deadline
+from orgxtract.edition import block_hashes, ChangeReport, PriorEdition
+from orgxtract.export import (BULK_FORMATS, JsonLinesWriter, RecordWriter, export_outputs,
+                              merge_outputs, open_bulk_writer, page_record)
+from orgxtract.manifest import Manifest, fingerprint, hash_file
+from orgxtract.shared import open_documents, SharedDocument
+import orgxtract.telemetry as telemetry
+from orgxtract.telemetry import metrics, Reporter, span, timed
 
-def run():
-    parser = argparse.ArgumentParser(prog=__package__)
+logger = logging.getLogger(__package__)
+
+FILE_EXTENSIONS = {"json": ".json", "jsonl": ".jsonl"}
+LOG_LEVELS = ["NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# Max amount of pages whose texts are processed in a single spaCy batch
+MAX_TEXT_BATCH = 16
+
+class PageBudget:
+    """Limits the amount of pages being processed at once
+
+    Every page holds its Drawing and Document until it is done. The budget
+    bounds the amount of those pages and optionally stops admitting pages
+    while the resident memory of the process exceeds max_memory (bytes).
+    A single page is always admitted to guarantee progress.
+    """
+
+    def __init__(self, max_pages: int, max_memory: Optional[int] = None):
+        self.max_pages = max(1, max_pages)
+        self.max_memory = max_memory
+        self.pages = 0
+        self.condition = Condition()
+
+    def acquire(self):
+        with self.condition:
+            # Memory is freed without a page being released, e.g. by the
+            # garbage collector, which is why the wait is limited.
+            while 0 < self.pages and (self.max_pages <= self.pages or self.is_memory_exceeded()):
+                self.condition.wait(timeout=0.1)
+
+            self.pages += 1
+
+    def try_acquire(self) -> bool:
+        """Admits a page unless acquire would have to wait"""
+
+        with self.condition:
+            if 0 < self.pages and (self.max_pages <= self.pages or self.is_memory_exceeded()):
+                return False
+
+            self.pages += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.pages -= 1
+            self.condition.notify()
+
+    def is_memory_exceeded(self) -> bool:
+        if self.max_memory == None:
+            return False
+
+        memory = resident_memory()
+
+        return memory != None and self.max_memory < memory
+
+class Furniture:
+    """Shares the results of text blocks repeated on the pages of a document
+
+    Bundles of charts repeat their header, legend and footer on every page,
+    i.e. the same text at the same place, which share a block hash. The first
+    page claiming a block analyses it and publishes the result, all
+    other pages wait for it and mark their copy as furniture. The first
+    occurrence is only known to be furniture once the other pages claimed
+    it, which is why complete outputs are marked afterwards by mark.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.futures: dict[str, Future] = {}
+        self.repeated: set[str] = set()
+
+    def claim(self, hashes: list[str]) -> tuple[Future, bool]:
+        """Returns the future of the result of the block and whether to analyse it
+
+        The hashes are the block_hashes of the block, the first one is its
+        own.
+        """
+
+        with self.lock:
+            for hash in hashes:
+                future = self.futures.get(hash)
+
+                if future != None:
+                    self.repeated.add(hash)
+                    return (future, False)
+
+            future = Future()
+            self.futures[hashes[0]] = future
+            return (future, True)
+
+    def publish(self, future: Future, output: Optional[dict]):
+        """Sets the result of a claimed block, None if it was not analysed"""
+
+        try:
+            future.set_result(copy.deepcopy(output))
+        except InvalidStateError:
+            pass
+
+    def mark(self, content: dict):
+        """Marks the first occurrences of repeated blocks in the page results"""
+
+        with self.lock:
+            repeated = set(self.repeated)
+
+        for result in content.values():
+            if not isinstance(result, dict):
+                continue
+
+            for output in result["content"]:
+                if output.get("hash") in repeated:
+                    output["furniture"] = True
+
+def resident_memory() -> Optional[int]:
+    """Returns the resident memory of the process in bytes if available"""
+
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+@dataclass(slots=True)
+class Context:
+    """The state shared by the stages of a CLI run or server"""
+
+    executor: Executor
+    task_queue: Queue
+    text_executor: Executor
+    budget: PageBudget
+    text_processing: Optional[Future] = None
+    # Set as soon as the text pipeline is loaded
+    ready: Event = field(default_factory=Event)
+    format: str = "json"
+    # Records written to a single target shared by all files (JSON Lines to
+    # stdout or a bulk format)
+    writer: Optional[RecordWriter] = None
+    manifest: Optional[Manifest] = None
+    # Seconds until rectangle detection and text analysis of a page are cut
+    # short
+    page_timeout: Optional[float] = None
+    analysis_timeout: Optional[float] = None
+    # Tolerance of the rectangle detection, None chooses it per page
+    tolerance: Optional[float] = 1.0
+    # Results of the text blocks of a previous edition, which are not
+    # analysed again
+    previous: Optional[PriorEdition] = None
+    changes: Optional[ChangeReport] = None
+    # Processes extracting the Documents of pages, which pass them through
+    # shared memory
+    extract_executor: Optional[Executor] = None
+    # Keeps the JSON documents of files written to stdout whole
+    stdout_lock: Lock = field(default_factory=Lock)
+    # Metrics or the progress are reported, which needs the pages of skipped
+    # files counted
+    is_reporting: bool = False
+
+    @staticmethod
+    def start(config: dict) -> "Context":
+        """Creates the worker pools and starts loading the text pipeline"""
+
+        n_threads = config.get("worker_threads", 4)
+        max_memory = config.get("max_memory")
+        tolerance = config.get("tolerance", 1.0)
+        budget = PageBudget(config.get("max_inflight_pages", 2 * n_threads),
+                            max_memory * 1024 * 1024 if max_memory != None else None)
+        context = Context(ThreadPoolExecutor(max_workers=n_threads),
+                          Queue(max(1, n_threads)),
+                          ThreadPoolExecutor(max_workers=1),
+                          budget,
+                          page_timeout=config.get("page_timeout"),
+                          analysis_timeout=config.get("analysis_timeout"),
+                          tolerance=None if tolerance == "auto" else tolerance)
+
+        if 0 < config.get("extract_processes", 0):
+            # The workers start with the first page, when the text thread is
+            # running already, which rules out forking.
+            context.extract_executor = ProcessPoolExecutor(config["extract_processes"],
+                                                           multiprocessing.get_context("spawn"))
+
+        metrics.gauge("text_queue_depth", context.task_queue.qsize)
+        metrics.gauge("pages_in_flight", lambda: budget.pages)
+
+        # Process all text in a separate thread
+        #
+        # The text pipeline components are created once to avoid using too
+        # much memory accidentally.
+        context.text_processing = context.text_executor.submit(process_text, context, config)
+
+        return context
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        # Signals text processing thread to shutdown
+        self.task_queue.put(None)
+        self.text_executor.shutdown(wait=False)
+
+        if self.extract_executor != None:
+            self.extract_executor.shutdown(wait=False, cancel_futures=True)
+
+def run(argv: Optional[list[str]] = None):
+    if argv == None:
+        argv = sys.argv[1:]
+
+    if 0 < len(argv) and argv[0] == "merge":
+        return run_merge(argv[1:])
+
+    if 0 < len(argv) and argv[0] == "serve":
+        return run_serve(argv[1:])
+
+    if 0 < len(argv) and argv[0] == "export":
+        return run_export(argv[1:])
+
+    parser = argparse.ArgumentParser(prog=__package__,
+                                     epilog=f"Run '{__package__} merge --help' "
+                                            "to merge the outputs of shards and "
+                                            f"'{__package__} serve --help' to run "
+                                            "a server extracting uploaded PDFs and "
+                                            f"'{__package__} export --help' to load "
+                                            "outputs into SQLite or Parquet.")
 
     parser.add_argument("input",
                         help="source file or directory containing source files for extraction")
     parser.add_argument("-o", "--output",
                         help="target file or directory to write the extracted content to")
+    add_pipeline_arguments(parser)
+    parser.add_argument("--extract-processes",
+                        help="extract the geometry of pages in this amount of processes, which pass "
+                             "it through shared memory (metrics and traces of those stages are not "
+                             "recorded)",
+                        type=int)
+    parser.add_argument("-f", "--max-files",
+                        help="max amount of files processed at the same time",
+                        type=int,
+                        default=2)
+    parser.add_argument("--format",
+                        help="output format, jsonl writes one record per page as soon as it is done, "
+                             "sqlite and parquet write the units and persons of all files to tables "
+                             "in the database or directory given by --output",
+                        choices=list(FILE_EXTENSIONS) + list(BULK_FORMATS),
+                        default="json")
+    parser.add_argument("-r", "--recursive",
+                        help="search the input directory recursively",
+                        action="store_true")
+    parser.add_argument("--include",
+                        help="glob pattern of files in the input directory to process (repeatable)",
+                        action="append")
+    parser.add_argument("--exclude",
+                        help="glob pattern of files in the input directory to skip (repeatable)",
+                        action="append")
+    parser.add_argument("--shard",
+                        help="process only the slice i/n of the input files, e.g. 0/4",
+                        type=Shard.parse)
+    parser.add_argument("--shard-pages",
+                        help="split files with more pages than this across the shards by page",
+                        type=int)
+    parser.add_argument("-i", "--incremental",
+                        help="skip inputs whose output is up to date according to the manifest next to the output",
+                        action="store_true")
+    parser.add_argument("--force",
+                        help="process all inputs in incremental mode and rewrite the manifest",
+                        action="store_true")
+    parser.add_argument("--previous",
+                        help="output (file or directory) of a previous edition, whose unchanged text "
+                             "blocks are reused instead of analysed again (repeatable)",
+                        action="append")
+    parser.add_argument("--change-report",
+                        help="file to write the reused, analysed and removed text blocks to "
+                             "(default: <output>.changes.json with --previous)")
+    parser.add_argument("--progress",
+                        help="display the progress and throughput on stderr",
+                        action="store_true")
+    parser.add_argument("--metrics",
+                        help="file to write metrics to, Prometheus text format for .prom or .txt, otherwise JSON")
+    parser.add_argument("--metrics-interval",
+                        help="seconds between writes of the metrics file and progress updates",
+                        type=float,
+                        default=10.0)
+    parser.add_argument("--profile",
+                        help="file to write a trace of the stages of every page to (Chrome trace format, "
+                             "viewable in Perfetto)")
+    parser.add_argument("--profile-stats",
+                        help="file to write cProfile statistics of the run to (pstats format)")
+
+    args = parser.parse_args(argv)
+    config = parse_config(args)
+
+    if args.incremental and args.output == None:
+        parser.error("--incremental requires --output")
+
+    is_bulk = args.format in BULK_FORMATS
+
+    if is_bulk and args.output == None:
+        parser.error(f"--format {args.format} requires --output")
+
+    if is_bulk and args.incremental:
+        parser.error(f"--format {args.format} does not support --incremental")
+
+    if args.change_report != None and args.previous == None:
+        parser.error("--change-report requires --previous")
+
+    writer = open_bulk_writer(args.format, args.output) if is_bulk else None
+
+    # Tracing starts before the text pipeline is loaded, which only
+    # instruments the spaCy components while profiling.
+    if args.profile != None:
+        telemetry.start_tracing()
+
+    profiler = None
+
+    if args.profile_stats != None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # The files, pages and texts are processed in a pipeline. Several files
+    # are opened at once, so their pages keep the page workers busy while
+    # the text of the previous pages is still processed.
+    file_executor = ThreadPoolExecutor(max_workers=max(1, args.max_files))
+    context = Context.start(config)
+    context.format = args.format
+    context.writer = writer
+    context.is_reporting = args.metrics != None or args.progress
+
+    if args.format == "jsonl" and args.output == None:
+        context.writer = JsonLinesWriter(sys.stdout, closes_file=False)
+
+    if args.previous != None:
+        context.previous = PriorEdition.load(args.previous)
+        context.changes = ChangeReport(context.previous)
+
+    change_report = args.change_report
+
+    if change_report == None and args.previous != None and args.output != None:
+        change_report = ChangeReport.path_for(args.output)
+
+    if args.incremental:
+        manifest_fingerprint = fingerprint(args.data_path,
+                                           model=args.model,
+                                           format=args.format,
+                                           llm_max_tokens=args.llm_max_tokens,
+                                           tolerance=args.tolerance,
+                                           shard=args.shard,
+                                           shard_pages=args.shard_pages)
+        context.manifest = Manifest(Manifest.path_for(args.output), manifest_fingerprint)
+
+        if args.force:
+            context.manifest.files.clear()
+
+    display = None
+    finish = None
+    interval = args.metrics_interval
+
+    if args.progress:
+        display = ProgressDisplay()
+        finish = display.finish
+        interval = min(interval, 0.5)
+
+    reporter = contextlib.nullcontext()
+
+    if args.metrics != None or args.progress:
+        reporter = Reporter(interval, args.metrics, display, finish)
+
+    try:
+        # The reporter stops after the pipeline, so its last report has the
+        # final metrics.
+        with reporter:
+            try:
+                process_inputs(args, context, file_executor, is_bulk)
+            finally:
+                file_executor.shutdown(wait=False, cancel_futures=True)
+                context.close()
+    finally:
+        if profiler != None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_stats)
+
+        if args.profile != None:
+            telemetry.stop_tracing().write(args.profile)
+
+        if context.writer != None:
+            context.writer.close()
+
+        if context.manifest != None:
+            context.manifest.save()
+            print(f"{context.manifest.processed} processed, {context.manifest.skipped} skipped",
+                  file=sys.stderr)
+
+        if context.changes != None:
+            if change_report != None:
+                context.changes.write(change_report)
+
+            print(context.changes.summary(), file=sys.stderr)
+
+def process_inputs(args, context: Context, file_executor: Executor, is_bulk: bool):
+    input = args.input
+    # Bulk formats write all files to the shared writer.
+    output = args.output if not is_bulk else None
+
+    if os.path.isfile(input):
+        pages = select_pages(args, input, os.path.basename(input))
+
+        if pages != []:
+            if args.progress:
+                count_expected_pages(input, pages)
+
+            write_stdout(context, process_input(context, input, output, pages))
+    elif os.path.isdir(input):
+        files = []
+
+        for path in discover(input, args.recursive, args.include, args.exclude):
+            input_file = os.path.join(input, path)
+            output_file = output
+            pages = select_pages(args, input_file, path)
+
+            if pages == []:
+                continue
+
+            if args.progress:
+                count_expected_pages(input_file, pages)
+
+            # The output mirrors the directory structure of the input.
+            if output != None:
+                (name, _) = os.path.splitext(path)
+                output_file = os.path.join(output, name + FILE_EXTENSIONS[args.format])
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+            files.append(file_executor.submit(process_input, context,
+                                              input_file, output_file, pages))
+
+        # Files finish in order of submission to raise the first error, which
+        # also keeps the order of the documents written to stdout.
+        for file in files:
+            write_stdout(context, file.result())
+    else:
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                input)
+
+def write_stdout(context: Context, document: Optional[str]):
+    if document != None:
+        with context.stdout_lock:
+            sys.stdout.write(document)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+def run_merge(argv: list[str]):
+    parser = argparse.ArgumentParser(prog=f"{__package__} merge",
+                                     description="merges the JSON or JSON Lines outputs of shards")
+
+    parser.add_argument("inputs",
+                        help="output files or directories of the shards",
+                        nargs="+")
+    parser.add_argument("-o", "--output",
+                        help="target file or directory to write the merged content to",
+                        required=True)
+    parser.add_argument("--log-level",
+                        help="logging level",
+                        choices=LOG_LEVELS,
+                        default="WARNING")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    merge_outputs(args.inputs, args.output)
+
+def run_export(argv: list[str]):
+    parser = argparse.ArgumentParser(prog=f"{__package__} export",
+                                     description="loads JSON or JSON Lines outputs into the tables "
+                                                 "of an SQLite database or Parquet files")
+
+    parser.add_argument("inputs",
+                        help="output files or directories",
+                        nargs="+")
+    parser.add_argument("-o", "--output",
+                        help="target database or directory of the Parquet files",
+                        required=True)
+    parser.add_argument("--format",
+                        help="target format",
+                        choices=list(BULK_FORMATS),
+                        default="sqlite")
+    parser.add_argument("--log-level",
+                        help="logging level",
+                        choices=LOG_LEVELS,
+                        default="WARNING")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+
+    with open_bulk_writer(args.format, args.output) as writer:
+        export_outputs(args.inputs, writer)
+
+def run_serve(argv: list[str]):
+    parser = argparse.ArgumentParser(prog=f"{__package__} serve",
+                                     description="extracts uploaded PDFs with a warm pipeline: "
+                                                 "POST /extract (PDF as body), GET /health, GET /queue")
+
+    parser.add_argument("--host",
+                        help="address to listen on",
+                        default="127.0.0.1")
+    parser.add_argument("-p", "--port",
+                        help="port to listen on",
+                        type=int,
+                        default=8080)
+    parser.add_argument("-s", "--socket",
+                        help="path of a Unix socket to listen on instead of a TCP port")
+    add_pipeline_arguments(parser)
+
+    args = parser.parse_args(argv)
+    config = parse_config(args)
+
+    from orgxtract.server import serve
+
+    context = Context.start(config)
+
+    try:
+        serve(context, args.host, args.port, args.socket)
+    finally:
+        context.close()
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser):
     parser.add_argument("-m", "--model",
-                        help="name of LLM to use for content extraction")
+                        help="name of LLM to use for content extraction "
+                             "(local:URL selects a local OpenAI compatible server)")
     parser.add_argument("-k", "--key",
                         help="API key of LLM")
     parser.add_argument("-d", "--data-path",
@@ -28,12 +559,42 @@ def run():
                         help="max amount of spawned threads for page extraction and LLM tasks",
                         type=int,
                         default=4)
+    parser.add_argument("--llm-max-tokens",
+                        help="token budget of a text chunk sent to the LLM (0 disables chunking)",
+                        type=int,
+                        default=2048)
+    parser.add_argument("--tolerance",
+                        help="max gap (points) between the lines of a box, 'auto' chooses "
+                             "the best of 0.5, 1, 2 and 4 per page (default: 1)",
+                        type=parse_tolerance)
+    parser.add_argument("--page-timeout",
+                        help="seconds after which the rectangle detection of a page is cut short",
+                        type=float)
+    parser.add_argument("--analysis-timeout",
+                        help="seconds after which a page falls back to the text of its blocks "
+                             "(if not analysed by spaCy yet) or the spaCy result (if the LLM is not done)",
+                        type=float)
+    parser.add_argument("--llm-timeout",
+                        help="seconds after which an LLM request is abandoned",
+                        type=float)
+    parser.add_argument("--max-inflight-pages",
+                        help="max amount of pages extracted and processed at once (default: 2 per worker thread)",
+                        type=int)
+    parser.add_argument("--max-memory",
+                        help="resident memory in MiB above which no further pages are started",
+                        type=int)
     parser.add_argument("--log-level",
                         help="logging level",
-                        choices=["NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        choices=LOG_LEVELS,
                         default="WARNING")
 
-    args = parser.parse_args()
+def parse_tolerance(value: str) -> float | str:
+    if value == "auto":
+        return value
+
+    return float(value)
+
+def parse_config(args) -> dict:
     config = {key:value for (key, value) in vars(args).items() if value != None}
 
     if args.key == None and "API_KEY" in os.environ:
@@ -41,103 +602,480 @@ def run():
 
     logging.basicConfig(level=args.log_level)
 
-    executor = ThreadPoolExecutor(max_workers=args.worker_threads)
-    task_queue = Queue(1)
+    return config
 
-    try:
-        # Process all text in a separate thread
-        #
-        # The text pipeline components are created once to avoid using too
-        # much memory accidentally.
-        text_processing = executor.submit(process_text, task_queue, config)
+def load_pdf():
+    """Returns orgxtract.pdf, which is imported on first use
 
-        input = args.input
-        output = args.output
+    pymupdf takes long to import and the merge and export commands as well as
+    --help do without it.
+    """
 
-        if os.path.isfile(input):
-            process_file(executor, task_queue, input, output)
-        elif os.path.isdir(input):
-            for filename in os.listdir(input):
-                input_file = os.path.join(input, filename)
-                output_file = output
+    import orgxtract.pdf as pdf
+    return pdf
 
-                if output != None:
-                    (name, _) = os.path.splitext(filename)
-                    output_file = os.path.join(output, name + ".json")
-                   
-                process_file(executor, task_queue, input_file, output_file)
+def select_pages(args, input: str, path: str) -> Optional[list[int]]:
+    """Returns the pages of the input in the shard
+
+    None selects all pages and an empty list none. Files with more pages than
+    --shard-pages are split across the shards by page, all other files are
+    assigned as a whole.
+    """
+
+    shard = args.shard
+
+    if shard == None:
+        return None
+
+    if args.shard_pages != None:
+        count = load_pdf().page_count(input)
+
+        if args.shard_pages < count:
+            return [p for p in range(0, count) if shard.contains_page(path, p)]
+
+    return None if shard.contains(path) else []
+
+def process_input(
+        context: Context,
+        input: str,
+        output: Optional[str],
+        pages: Optional[list[int]] = None) -> Optional[str]:
+    """Processes the input unless it is up to date, see process_file"""
+
+    manifest = context.manifest
+
+    if manifest == None:
+        document = process_file(context, input, output, pages)
+        metrics.count("files_total")
+        return document
+
+    digest = hash_file(input)
+
+    if manifest.is_current(input, digest, output):
+        logger.info("Skipped up to date %s", input)
+        manifest.skip()
+        metrics.count("files_skipped_total")
+
+        # Counting the pages opens the PDF.
+        if context.is_reporting:
+            metrics.count("pages_skipped_total", count_pages(input, pages))
+        return None
+
+    document = process_file(context, input, output, pages)
+    manifest.update(input, digest, output)
+    metrics.count("files_total")
+
+    return document
+
+def count_expected_pages(input: str, pages: Optional[list[int]]):
+    metrics.count("pages_expected_total", count_pages(input, pages))
+
+def count_pages(input: str, pages: Optional[list[int]]) -> int:
+    return len(pages) if pages != None else load_pdf().page_count(input)
+
+class ProgressDisplay:
+    """Refreshes a progress bar of the pages on stderr, see Reporter
+
+    The bar is redrawn in place, the line is only ended by finish.
+    """
+
+    def __init__(self):
+        self.is_shown = False
+
+    def __call__(self, snapshot: dict):
+        counters = snapshot["counters"]
+        total = counters.get("pages_expected_total", 0)
+        done = counters.get("pages_total", 0)
+        pages = done + counters.get("pages_skipped_total", 0)
+
+        if total == 0:
+            return
+
+        throughput = done / max(snapshot["elapsed_seconds"], 1e-9)
+        failures = counters.get("llm_failures_total", 0)
+
+        print_progress_bar(min(pages, total), total,
+                           prefix="Pages",
+                           suffix=f"{throughput:.2f} pages/s, {failures:g} LLM failures",
+                           length=40,
+                           file=sys.stderr)
+        self.is_shown = True
+
+    def finish(self):
+        if self.is_shown:
+            print(file=sys.stderr)
+
+def process_file(
+        context: Context,
+        input: str,
+        output: Optional[str],
+        pages: Optional[list[int]] = None) -> Optional[str]:
+    """Extracts the pages of the input to the output
+
+    Without an output the JSON document is returned instead, so the files
+    processed concurrently are written to stdout one after another.
+    """
+
+    is_admitted = context.extract_executor != None
+
+    if is_admitted:
+        # The budget admits pages before their extraction.
+        drawings = open_documents(context.extract_executor, input, pages, context.tolerance,
+                                  context.page_timeout, budget=context.budget)
+    else:
+        drawings = load_pdf().open_pages(input, pages)
+
+    if context.format != "json":
+        # Pages are written as soon as they are done, the records carry the
+        # order.
+        writer = JsonLinesWriter.open(output) if output != None else context.writer
+
+        def write(index: int, result):
+            writer.write(page_record(input, index, result))
+
+        try:
+            futures = submit_pages(context, drawings, write, input, Furniture(),
+                                   is_admitted)
+
+            # Raises the error of the first failed page or write. A page is
+            # only done once it is written, so the writer is not closed before.
+            for future in futures:
+                future.result()
+        finally:
+            if output != None:
+                writer.close()
+
+        return None
+
+    furniture = Furniture()
+    futures = submit_pages(context, drawings, file=input, furniture=furniture,
+                           is_admitted=is_admitted)
+    content = {index:future.result() for (future, index) in futures.items()}
+    furniture.mark(content)
+
+    if output == None:
+        return json.dumps(content, ensure_ascii=False, indent=4)
+
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(content, file, ensure_ascii=False, separators=(",", ":"))
+
+    return None
+
+def submit_pages(
+        context: Context,
+        drawings: Iterator[tuple[int, Drawing | SharedDocument]],
+        on_done: Optional[Callable[[int, Any], None]] = None,
+        file: Optional[str] = None,
+        furniture: Optional[Furniture] = None,
+        is_admitted: bool = False) -> dict[Future, int]:
+    """Returns the futures of the page results mapped to the page index
+
+    The next drawing is only extracted when the page budget admits another
+    page, so this blocks until the last page is submitted. Drawings that
+    are admitted already, e.g. by open_documents, are taken as they come.
+    Either way, the budget is released when a page is done. The callback is
+    called by the worker with the page index and result of every page
+    before its future is done, so its errors fail the page. The file
+    the pages belong to is only used for reporting. Blocks repeated on the
+    pages are analysed once if furniture is given. Instead of drawings the
+    documents of pages extracted by other processes can be submitted.
+    """
+
+    budget = context.budget
+    futures = {}
+
+    while True:
+        if not is_admitted:
+            budget.acquire()
+
+        try:
+            (index, drawing) = next(drawings)
+        except StopIteration:
+            if not is_admitted:
+                budget.release()
+
+            break
+        except BaseException:
+            if not is_admitted:
+                budget.release()
+
+            raise
+
+        future = context.executor.submit(process_drawing, context, drawing, index, file,
+                                         furniture, on_done)
+
+        if isinstance(drawing, SharedDocument):
+            # The documents of pages that never ran are released here.
+            future.add_done_callback(lambda future, shared=drawing: future.cancelled() and shared.release())
+
+        # Only the worker may keep the drawing alive.
+        del drawing
+        future.add_done_callback(lambda _future: budget.release())
+
+        futures[future] = index
+
+    return futures
+
+def remaining(deadline: Optional[Deadline]) -> Optional[float]:
+    return deadline.remaining() if deadline != None else None
+
+def process_drawing(
+        context: Context,
+        drawing: Drawing | SharedDocument,
+        index: Optional[int] = None,
+        file: Optional[str] = None,
+        furniture: Optional[Furniture] = None,
+        on_done: Optional[Callable[[int, Any], None]] = None):
+    with timed("page_seconds", page=index):
+        if not isinstance(drawing, SharedDocument):
+            result = extract_page(context, drawing, index, file, furniture)
         else:
-            raise FileNotFoundError(errno.ENOENT,
-                                    os.strerror(errno.ENOENT),
-                                    input)
-    finally:
-        executor.shutdown(wait=False, cancel_futures=True)
-        # Signals text processing thread to shutdown
-        task_queue.put(None)
+            try:
+                result = analyse_page(context, drawing.document(), index, file, furniture)
+            finally:
+                drawing.release()
 
-def process_file(executor: Executor, task_queue: Queue, input: str, output: Optional[str]):
-    drawings = pdf.open(input)
-    results = executor.map(lambda d: process_drawing(d, task_queue), drawings)
-    content = {index:result for (index, result) in enumerate(results)}
+    if on_done != None:
+        on_done(index, result)
 
-    if output != None:
-        with open(output, "w", encoding="utf-8") as file:
-            json.dump(content, file, ensure_ascii=False, separators=(",", ":"))
+    return result
+
+def extract_page(
+        context: Context,
+        drawing: Drawing,
+        index: Optional[int] = None,
+        file: Optional[str] = None,
+        furniture: Optional[Furniture] = None):
+    deadline = Deadline.after(context.page_timeout)
+
+    if context.tolerance != None:
+        document = Document.extract(drawing, context.tolerance, deadline)
     else:
-        json.dump(content, sys.stdout, ensure_ascii=False, indent=4)
+        document = Document.extract_best(drawing, deadline=deadline)
+
+    return analyse_page(context, document, index, file, furniture)
 
-def process_drawing(drawing: Drawing, task_queue: Queue):
-    document = Document.extract(drawing)
+def analyse_page(
+        context: Context,
+        document: Document,
+        index: Optional[int] = None,
+        file: Optional[str] = None,
+        furniture: Optional[Furniture] = None):
+    metrics.observe("page_blocks", len(document.text_blocks))
 
     if len(document.text_blocks) == 0:
+        metrics.count("pages_total")
         return []
 
+    rects = tuple(document.text_contents.keys())
     inputs = tuple(document.text_contents.values())
-    oneshot = SimpleQueue()
+    candidates = tuple(block_hashes(text, document.rects[rect]) for (rect, text) in zip(rects, inputs))
+    hashes = tuple(block[0] for block in candidates)
+    outputs: list[Optional[dict]] = [None] * len(inputs)
+    # Hashes of the blocks of the previous edition matching the blocks
+    matches: list[Optional[str]] = [None] * len(inputs)
+
+    # Blocks unchanged since the previous edition keep their results.
+    if context.previous != None:
+        matches = [context.previous.match(block) for block in candidates]
+        outputs = [context.previous.get(hash) if hash != None else None for hash in matches]
+
+    analysed = [i for (i, output) in enumerate(outputs) if output == None]
+    # Futures of the results of blocks repeated on pages of the document, which
+    # are analysed by the page the block was first seen on
+    owned: dict[int, Future] = {}
+    copies: dict[int, Future] = {}
+    repeated = set()
+
+    if furniture != None:
+        for (i, block) in enumerate(candidates):
+            (future, is_owner) = furniture.claim(block)
 
-    task_queue.put((oneshot, inputs))
+            if is_owner and outputs[i] != None:
+                furniture.publish(future, outputs[i])
+            elif is_owner:
+                owned[i] = future
+            else:
+                repeated.add(i)
 
-    outputs = oneshot.get()
+                if outputs[i] == None:
+                    copies[i] = future
+
+    pending = [i for i in analysed if i not in copies]
+    texts = tuple(inputs[i] for i in pending)
+    deadline = Deadline.after(context.analysis_timeout)
     result = {}
+
+    try:
+        if 0 < len(pending):
+            oneshot = SimpleQueue()
+            # The spans show how long pages wait for the text thread and the LLM.
+            with span("text_queue_wait", texts=len(texts)):
+                try:
+                    context.task_queue.put((oneshot, texts, deadline), timeout=remaining(deadline))
+                    futures = oneshot.get(timeout=remaining(deadline))
+                except (Empty, Full):
+                    futures = None
+
+            # The text thread did not get to the page in time, only the
+            # geometry and the text of the blocks are left.
+            if futures == None:
+                logger.warning("Page not analysed by deadline")
+                metrics.count("queue_timeouts_total")
+                result["status"] = "geometry_only"
+
+                for i in pending:
+                    outputs[i] = {"text": inputs[i]}
+            else:
+                with span("text_analysis_wait", texts=len(texts)):
+                    for (i, future) in zip(pending, futures):
+                        outputs[i] = future.result()
+
+                        if i in owned:
+                            furniture.publish(owned[i], outputs[i])
+    finally:
+        # The other pages must not wait for blocks this page failed to analyse.
+        for future in owned.values():
+            furniture.publish(future, None)
+
+    if 0 < len(copies):
+        metrics.count("furniture_blocks_total", len(copies))
+
+        with span("furniture_wait", texts=len(copies)):
+            for (i, future) in copies.items():
+                try:
+                    output = future.result(timeout=remaining(deadline))
+                except TimeoutError:
+                    output = None
+
+                if output != None:
+                    outputs[i] = copy.deepcopy(output)
+                else:
+                    result["status"] = "geometry_only"
+                    outputs[i] = {"text": inputs[i]}
+
+    if context.changes != None:
+        analysed_set = set(analysed)
+        context.changes.add(file, index,
+                            [(rects[i], hashes[i], matches[i])
+                             for i in range(len(inputs)) if i not in analysed_set],
+                            [(rects[i], hashes[i], inputs[i]) for i in analysed])
+        metrics.count("blocks_reused_total", len(inputs) - len(analysed))
+
     metadata = {}
     content = []
+    discarded = []
+
+    for (i, output) in enumerate(outputs):
+        # The text pipeline shut down before the page was analysed.
+        if output == None:
+            continue
+
+        output["rect"] = rects[i]
+        output["hash"] = hashes[i]
+
+        if i in repeated:
+            output["furniture"] = True
 
-    for output in outputs:
         if "date" in output:
             metadata["date"] = output["date"]
+            # Lets the next edition reuse the date with the block
+            metadata["date_block"] = hashes[i]
             del output["date"]
 
-        if (output.get("name") != None or bool(output.get("persons"))):
+        if "status" in output:
+            result["status"] = output.pop("status")
+
+        if (output.get("name") != None or bool(output.get("persons")) or "text" in output):
             content.append(output)
-            
+        else:
+            discarded.append(hashes[i])
 
     if 0 < len(metadata):
         result["metadata"] = metadata
 
+    if document.is_partial:
+        result["partial_geometry"] = True
+
     result["content"] = content
 
+    # The hashes of the blocks without content let the next edition skip them.
+    if 0 < len(discarded):
+        result["discarded"] = discarded
+
+    metrics.count("pages_total")
+
     return result
 
-def process_text(task_queue: Queue, config):
-    with TextPipeline(data_path=config.get("data_path"),
-                      llm_model=config.get("model"),
-                      llm_key=config.get("key"),
-                      n_threads=config.get("worker_threads")) as pipeline:
-        for (oneshot, inputs) in iter(task_queue.get, None):
-            outputs = tuple(pipeline.pipe(inputs))
+def process_text(context: Context, config: dict):
+    from orgxtract.text_pipeline import TextPipeline
 
-            oneshot.put(outputs)
+    task_queue = context.task_queue
 
-    # Shutdowns any waiting producer threads (process_drawing)
-    while 0 < task_queue.qsize():
-        (oneshot, _) = task_queue.get_nowait()
+    try:
+        with TextPipeline(data_path=config.get("data_path"),
+                          llm_model=config.get("model"),
+                          llm_key=config.get("key"),
+                          n_threads=config.get("worker_threads"),
+                          llm_max_tokens=config.get("llm_max_tokens") or None,
+                          llm_timeout=config.get("llm_timeout")) as pipeline:
+            context.ready.set()
+            is_running = True
+
+            # Only spaCy runs in this thread, the LLM requests of a page are
+            # still in flight when the next page is taken.
+            while is_running:
+                task = task_queue.get()
+
+                if task == None:
+                    break
+
+                tasks = [task]
+
+                # Pages waiting in the queue, e.g. of concurrent files or
+                # requests, are processed in a single spaCy batch.
+                while len(tasks) < MAX_TEXT_BATCH and not task_queue.empty():
+                    task = task_queue.get_nowait()
+
+                    if task == None:
+                        is_running = False
+                        break
+
+                    tasks.append(task)
+
+                # Pages whose deadline passed in the queue are not waited
+                # for anymore.
+                pending = []
+
+                for task in tasks:
+                    (oneshot, _, deadline) = task
+
+                    if deadline != None and deadline.is_expired():
+                        oneshot.put(None)
+                    else:
+                        pending.append(task)
+
+                tasks = pending
+
+                with span("text_batch", pages=len(tasks)):
+                    futures = pipeline.submit([text for (_, texts, _) in tasks for text in texts],
+                                              [deadline for (_, texts, deadline) in tasks for text in texts])
+                offset = 0
+
+                for (oneshot, texts, _) in tasks:
+                    oneshot.put(futures[offset:offset + len(texts)])
+                    offset += len(texts)
+    finally:
+        # Shutdowns any waiting producer threads (process_drawing)
+        while 0 < task_queue.qsize():
+            task = task_queue.get_nowait()
 
-        oneshot.put(())
+            if task != None:
+                (oneshot, _, _) = task
+                oneshot.put(())
 
-def print_progress_bar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
+def print_progress_bar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r", file = None):
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
-    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
-    if iteration == total: 
-        print()
+    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd, file = file)
@@ -0,0 +1,72 @@
+from fnmatch import fnmatch
+import hashlib
+import os
+from typing import Iterator, NamedTuple, Optional, Self
+
+def discover(
+        root: str,
+        recursive: bool = False,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None) -> list[str]:
+    """Returns the paths of the files in root relative to it
+
+    The glob patterns are matched against the relative path (with / as
+    separator) and the file name. Without include patterns every file is
+    included. The paths are sorted, so every machine gets the same order.
+    """
+
+    def matches(path: str, name: str, patterns: list[str]) -> bool:
+        return any(fnmatch(path, p) or fnmatch(name, p) for p in patterns)
+
+    def scan(directory: str, prefix: str) -> Iterator[str]:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                path = prefix + entry.name
+
+                if entry.is_dir():
+                    if recursive:
+                        yield from scan(entry.path, path + "/")
+                elif entry.is_file():
+                    if include and not matches(path, entry.name, include):
+                        continue
+
+                    if exclude and matches(path, entry.name, exclude):
+                        continue
+
+                    yield path
+
+    return sorted(scan(root, ""))
+
+class Shard(NamedTuple):
+    """Represents the slice i of n of a corpus
+
+    Files (or pages) are assigned to a shard by a stable hash of their
+    relative path, so independent machines get exact, non-overlapping
+    slices without coordination.
+    """
+
+    index: int
+    count: int
+
+    @staticmethod
+    def parse(value: str) -> Self:
+        """Parses a shard in the form i/n with 0 <= i < n"""
+
+        (index, _, count) = value.partition("/")
+        shard = Shard(int(index), int(count))
+
+        if not (0 <= shard.index < shard.count):
+            raise ValueError(f"invalid shard {value!r}")
+
+        return shard
+
+    def contains(self, key: str) -> bool:
+        return stable_hash(key) % self.count == self.index
+
+    def contains_page(self, path: str, page: int) -> bool:
+        return self.contains(f"{path}#{page}")
+
+def stable_hash(key: str) -> int:
+    # Python's hash is salted per process and thus unusable across machines.
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
@@ -0,0 +1,109 @@
+import heapq
+import itertools
+import logging
+from threading import Condition, Thread
+import time
+from typing import Callable, NamedTuple, Optional, Self
+
+logger = logging.getLogger(__package__)
+
+class DeadlineExceeded(TimeoutError):
+    """Raised by work cancelled because its deadline passed"""
+
+class Deadline(NamedTuple):
+    """Represents the point in time (time.monotonic) work has to be done by
+
+    Long running loops call check regularly, which cancels them
+    cooperatively once the deadline passed.
+    """
+
+    expires: float
+
+    @staticmethod
+    def after(seconds: Optional[float]) -> Optional[Self]:
+        """Returns the deadline in seconds from now or None without limit"""
+
+        if seconds == None:
+            return None
+
+        return Deadline(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def is_expired(self) -> bool:
+        return self.expires <= time.monotonic()
+
+    def check(self, stage: str):
+        if self.is_expired():
+            raise DeadlineExceeded(f"{stage} deadline exceeded")
+
+class Watchdog:
+    """Calls functions when their deadlines pass unless they are cancelled
+
+    It abandons work that cannot be cancelled cooperatively, e.g. a blocked
+    LLM request, by completing its future in place of the worker. A single
+    thread serves all deadlines. The functions must be short.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.heap: list[tuple[float, int, Callable[[], None]]] = []
+        # Handles of the functions neither called nor cancelled
+        self.pending: set[int] = set()
+        self.counter = itertools.count()
+        self.is_closed = False
+        self.thread = Thread(target=self.run, name="orgxtract-watchdog", daemon=True)
+        self.thread.start()
+
+    def schedule(self, deadline: Deadline, function: Callable[[], None]) -> int:
+        """Returns the handle to cancel the call of function"""
+
+        handle = next(self.counter)
+
+        with self.condition:
+            heapq.heappush(self.heap, (deadline.expires, handle, function))
+            self.pending.add(handle)
+            self.condition.notify()
+
+        return handle
+
+    def cancel(self, handle: int):
+        with self.condition:
+            self.pending.discard(handle)
+
+    def close(self):
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify()
+
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.is_closed:
+                    if 0 < len(self.heap):
+                        timeout = self.heap[0][0] - time.monotonic()
+
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+
+                    self.condition.wait(timeout)
+
+                if self.is_closed:
+                    return
+
+                (_, handle, function) = heapq.heappop(self.heap)
+
+                if handle not in self.pending:
+                    continue
+
+                self.pending.remove(handle)
+
+            try:
+                function()
+            except Exception as error:
+                logger.error("Deadline handler failed: %s(%s)", type(error).__name__, error)
@@ -2,12 +2,20 @@ import bisect
 from collections import defaultdict
 import logging
 from sys import float_info
-from typing import Self, NamedTuple
+from typing import Iterable, Optional, Self, NamedTuple
 
+from orgxtract.deadline import Deadline, DeadlineExceeded
 from orgxtract.drawing import Drawing, Line, Point, Rect, TextSpan
+from orgxtract.telemetry import metrics, span, timed
 
 logger = logging.getLogger(__package__)
 
+# Iterations of the detection loops between deadline checks
+DEADLINE_CHECK_INTERVAL = 64
+
+# Tolerances of Document.extract_tolerances and Document.extract_best
+TOLERANCES = (0.5, 1.0, 2.0, 4.0)
+
 class Document(NamedTuple):
     """Represents the organigram content extracted from a Drawing
 
@@ -29,50 +37,159 @@ class Document(NamedTuple):
     text_blocks: dict[int, list[int]]
     # Rect -> str
     text_contents: dict[int, str]
+    # Whether the rectangle detection was cancelled by the deadline, which
+    # leaves only the rectangles found so far.
+    is_partial: bool = False
 
     @staticmethod
-    def extract(drawing: Drawing, tolerance: float = 1.0) -> Self:
+    @timed("document_extract_seconds")
+    def extract(
+            drawing: Drawing,
+            tolerance: float = 1.0,
+            deadline: Optional[Deadline] = None) -> Self:
         """Creates a Document from a Drawing
 
         If many rectangles are drawn with four lines and there are gaps, it is
         possible to still detect them as rectangles by increasing the
         tolerance parameter.
+
+        The detection of rectangles made up of lines is cancelled when the
+        deadline passes. The text is then assigned to the rectangles found so
+        far and the document is marked as partial. The drawing is not
+        modified.
+        """
+
+        return extract_documents(drawing, [tolerance], deadline)[tolerance]
+
+    @staticmethod
+    @timed("document_extract_seconds")
+    def extract_tolerances(
+            drawing: Drawing,
+            tolerances: Iterable[float] = TOLERANCES,
+            deadline: Optional[Deadline] = None) -> dict[float, Self]:
+        """Creates a Document for every tolerance from a Drawing
+
+        The line intersections are computed once for the largest tolerance
+        together with their gap, every tolerance then only searches the
+        rectangles made up of the intersections within its tolerance. For
+        axis-aligned lines the documents are equal to those of extract.
+        """
+
+        return extract_documents(drawing, tolerances, deadline)
+
+    @staticmethod
+    @timed("document_extract_seconds")
+    def extract_best(
+            drawing: Drawing,
+            tolerances: Iterable[float] = TOLERANCES,
+            deadline: Optional[Deadline] = None) -> Self:
+        """Creates the Document of the tolerance with the best score
+
+        See score, of equal scores the tolerance with the fewest text blocks
+        and then the smallest tolerance is chosen.
         """
 
-        drawing.lines.sort(key=lambda l: (l.p0.x, l.p1.x, l.p0.y, l.p1.y))
-        dedup(drawing.lines)
+        documents = extract_documents(drawing, tolerances, deadline)
+        # The tolerances are sorted, so max keeps the smallest of equal keys.
+        tolerance = max(documents, key=lambda t: (score(documents[t]),
+                                                  -len(documents[t].text_blocks)))
+        logger.debug("Tolerance %g chosen", tolerance)
+
+        return documents[tolerance]
+
+def extract_documents(
+        drawing: Drawing,
+        tolerances: Iterable[float],
+        deadline: Optional[Deadline] = None) -> dict[float, Document]:
+    tolerances = sorted(set(tolerances))
+    is_partial = dict.fromkeys(tolerances, True)
+    rects_by_tolerance = {t:list(drawing.rects) for t in tolerances}
+
+    lines = sorted(drawing.lines, key=lambda l: (l.p0.x, l.p1.x, l.p0.y, l.p1.y))
+    dedup(lines)
+
+    # TODO: Calculate graph edges for edges
+    with span("document_extract_nodes", lines=len(lines), tolerances=len(tolerances)):
+        try:
+            junctions = extract_junctions(lines, tolerances[-1], deadline)
 
-        # TODO: Calculate graph edges for edges
-        _junctions = extract_nodes(drawing.rects, drawing.lines, tolerance)
+            for tolerance in tolerances:
+                extract_rects(rects_by_tolerance[tolerance], junctions, tolerance, deadline)
+                is_partial[tolerance] = False
+        except DeadlineExceeded:
+            logger.warning("Rectangle detection of %d lines cancelled", len(lines))
+            metrics.count("node_timeouts_total")
 
-        drawing.rects.append(Rect(0.0, 0.0, drawing.width, drawing.height))
-        drawing.rects.sort()
-        dedup(drawing.rects)
+    text_spans = sorted(drawing.text_spans,
+                        key=lambda ts: (ts.bbox.y0, ts.bbox.x0, ts.bbox.y1, ts.bbox.x1))
+    dedup(text_spans)
 
-        drawing.text_spans.sort(key=lambda ts: (ts.bbox.y0, ts.bbox.x0, ts.bbox.y1, ts.bbox.x1))
-        dedup(drawing.text_spans)
+    documents = {}
 
-        text_blocks = extract_text_blocks(drawing.rects, drawing.text_spans)
+    for tolerance in tolerances:
+        rects = rects_by_tolerance[tolerance]
+        rects.append(Rect(0.0, 0.0, drawing.width, drawing.height))
+        rects.sort()
+        dedup(rects)
+
+        with span("document_extract_text_blocks", rects=len(rects)):
+            text_blocks = extract_text_blocks(rects, text_spans)
 
         # TODO: The page rect has to be clustered in coarse regions, otherwise
         # text lines are made up of words that are far away from each other.
 
-        text_contents = {k:"".join(generate_text(drawing.text_spans, v))
-                        for (k, v) in text_blocks.items()}
+        with span("document_generate_text", blocks=len(text_blocks)):
+            text_contents = {k:"".join(generate_text(text_spans, v))
+                            for (k, v) in text_blocks.items()}
+
+        documents[tolerance] = Document(drawing.width, drawing.height,
+                                        rects, lines, text_spans,
+                                        text_blocks, text_contents, is_partial[tolerance])
+
+    return documents
 
-        return Document(drawing.width, drawing.height,
-                        drawing.rects, drawing.lines, drawing.text_spans,
-                        text_blocks, text_contents)
+def score(document: Document) -> int:
+    """Returns the amount of text spans within rectangles other than the page
+
+    Gaps in the lines of boxes leave their text on the page rectangle, so a
+    tolerance that closes the gaps scores higher. Spurious rectangles of a
+    too large tolerance mostly split boxes, which does not add to the score
+    but to the amount of text blocks.
+    """
+
+    page = Rect(0.0, 0.0, document.width, document.height)
+
+    return sum(len(text_block) for (r, text_block) in document.text_blocks.items()
+               if document.rects[r] != page)
 
 def extract_nodes(
         rects: list[Rect],
         lines: list[Line],
-        tolerance: float) -> dict[int, list[tuple[int, Point]]]:
-    junction_by_line: defaultdict[int, list[tuple[int, Point]]] = defaultdict(list)
+        tolerance: float,
+        deadline: Optional[Deadline] = None) -> dict[int, list[tuple[int, Point]]]:
+    junctions = extract_junctions(lines, tolerance, deadline)
+    extract_rects(rects, junctions, tolerance, deadline)
+
+    return {i:[(j, point) for (j, point, _) in js] for (i, js) in junctions.items()}
+
+def extract_junctions(
+        lines: list[Line],
+        tolerance: float,
+        deadline: Optional[Deadline] = None) -> dict[int, list[tuple[int, Point, float]]]:
+    """Returns the intersections of sorted lines with their gap by line
+
+    Lines are joined if their intersection is at most tolerance beyond their
+    ends, the gap is the distance beyond the ends.
+    """
+
+    junction_by_line: defaultdict[int, list[tuple[int, Point, float]]] = defaultdict(list)
     j_min = 0
 
     # Find line intersections
     for i in range(0, len(lines) - 1):
+        if deadline != None and i % DEADLINE_CHECK_INTERVAL == 0:
+            deadline.check("rectangle detection")
+
         line_i = lines[i]
         x0 = line_i.p0.x - tolerance
         x1 = line_i.p1.x + tolerance
@@ -84,10 +201,10 @@ def extract_nodes(
         for j in range(j_min, j_max):
             line_j = lines[j]
 
-            intersection = line_i.intersection(line_j, tolerance)
+            result = line_i.intersection_gap(line_j)
 
-            if intersection != None:
-                junction_by_line[i].append((j, intersection))
+            if result != None and result[1] <= tolerance:
+                junction_by_line[i].append((j, result[0], result[1]))
 
         for line_p in lines[j_min:]:
             if line_p.p1.x < x0:
@@ -95,8 +212,28 @@ def extract_nodes(
             else:
                 break
 
+    return junction_by_line
+
+def extract_rects(
+        rects: list[Rect],
+        junctions: dict[int, list[tuple[int, Point, float]]],
+        tolerance: float,
+        deadline: Optional[Deadline] = None):
+    """Appends the rectangles made up of 4 lines joined within tolerance"""
+
+    junction_by_line = {}
+
+    for (i, js) in junctions.items():
+        intersections = [(j, point) for (j, point, gap) in js if gap <= tolerance]
+
+        if len(intersections) != 0:
+            junction_by_line[i] = intersections
+
     # Search for rectangles made up of 4 lines
-    for (i, intersections) in junction_by_line.items():
+    for (n, (i, intersections)) in enumerate(junction_by_line.items()):
+        if deadline != None and n % DEADLINE_CHECK_INTERVAL == 0:
+            deadline.check("rectangle detection")
+
         if len(intersections) < 2:
             continue
 
@@ -131,8 +268,6 @@ def extract_nodes(
 
             # TODO: Remove lines that make up a rectangle by setting line to None at index
 
-    return junction_by_line
-
 def extract_text_blocks(
         rects: list[Rect],
         text_spans: list[TextSpan]) -> dict[int | None, list[int]]:
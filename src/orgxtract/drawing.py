@@ -49,7 +49,22 @@ class Line(NamedTuple):
     p0: Point
     p1: Point
 
-    def intersection(self, line: Self, tolerance: float) -> Optional[Self]:
+    def intersection(self, line: Self, tolerance: float) -> Optional[Point]:
+        result = self.intersection_gap(line)
+
+        if result == None or tolerance < result[1]:
+            return None
+
+        return result[0]
+
+    def intersection_gap(self, line: Self) -> Optional[tuple[Point, float]]:
+        """Returns the intersection of the extended lines and its gap
+
+        The gap is the distance the intersection lies beyond the ends of the
+        line segments, it is 0.0 if the segments intersect. Parallel lines
+        have no intersection.
+        """
+
         # Kurbo Library Source: https://github.com/linebender/kurbo/blob/884483b3de412c7c10e2fff4f43dbe96304c0dbd/src/line.rs#L44:c
         a = self.p1
         b = self.p0
@@ -78,15 +93,21 @@ class Line(NamedTuple):
         cd_new_x = cd_x * h
         cd_new_y = cd_y * h
 
-        # The values of g and h must be between 0 and 1, otherwise 
-        # check wether the offset is within tolerance.
-        if ((g < 0.0 and tolerance < grid_distance(ab_new_x, ab_new_y))
-                or (1.0 < g and tolerance < grid_distance(ab_new_x - ab_x, ab_new_y - ab_y))
-                or (h < 0.0 and tolerance < grid_distance(cd_new_x, cd_new_y))
-                or (1.0 < h and tolerance < grid_distance(cd_new_x - cd_x, cd_new_y - cd_y))):
-            return None
+        # The values of g and h are between 0 and 1 if the point is on both
+        # segments, otherwise the offset beyond the segment is the gap.
+        gap = 0.0
+
+        if g < 0.0:
+            gap = grid_distance(ab_new_x, ab_new_y)
+        elif 1.0 < g:
+            gap = grid_distance(ab_new_x - ab_x, ab_new_y - ab_y)
+
+        if h < 0.0:
+            gap = max(gap, grid_distance(cd_new_x, cd_new_y))
+        elif 1.0 < h:
+            gap = max(gap, grid_distance(cd_new_x - cd_x, cd_new_y - cd_y))
 
-        return Point(c.x + cd_new_x, c.y + cd_new_y)
+        return (Point(c.x + cd_new_x, c.y + cd_new_y), gap)
 
 class TextSpan(NamedTuple):
     """Represents a text span in a Drawing
@@ -0,0 +1,189 @@
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import os
+from threading import Lock
+from typing import Optional
+
+from orgxtract.drawing import Rect
+from orgxtract.export import read_outputs
+
+logger = logging.getLogger(__package__)
+
+# Grid (points) the rect of a block is snapped to before hashing
+BLOCK_GRID = 10.0
+# Shift (points) of every side of a block that always keeps it matching, less
+# than half the grid
+BLOCK_TOLERANCE = 2.0
+
+def normalize_text(text: str) -> str:
+    """Returns the text with collapsed whitespace but kept line breaks
+
+    Line breaks are kept since the text pipeline resolves hyphenations and
+    joins words along them.
+    """
+
+    return "\n".join(" ".join(line.split()) for line in text.strip().splitlines())
+
+def block_hashes(text: str, rect: Rect) -> list[str]:
+    """Returns the hashes identifying a text block across editions of a chart
+
+    The first hash is the one of the block, covering the normalised text and
+    the rect snapped to BLOCK_GRID. Since a small shift across a grid line
+    changes it, it is followed by the hashes with the neighbouring grid cell
+    of every side within BLOCK_TOLERANCE of a grid line. A block shifted by
+    up to BLOCK_TOLERANCE thus always has the hash of the block among them.
+    """
+
+    text = normalize_text(text)
+    candidates = []
+
+    for value in rect:
+        cell = round(value / BLOCK_GRID)
+        # The neighbour on the side of the value within the cell
+        neighbour = cell + 1 if cell * BLOCK_GRID <= value else cell - 1
+        border = (cell + neighbour) / 2 * BLOCK_GRID
+
+        if abs(value - border) <= BLOCK_TOLERANCE:
+            candidates.append((cell, neighbour))
+        else:
+            candidates.append((cell,))
+
+    return [hash_cells(text, cells) for cells in itertools.product(*candidates)]
+
+def hash_cells(text: str, cells: tuple[int, ...]) -> str:
+    key = ",".join(map(str, cells)) + "\n" + text
+
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+class PriorEdition:
+    """The results of the text blocks of a previous edition by block hash
+
+    The results are read from the outputs of a previous run. Blocks without
+    content are known from the discarded hashes of their page. Pages with a
+    status, i.e. whose analysis fell back to spaCy or the geometry, are not
+    reused.
+    """
+
+    def __init__(self):
+        self.results: dict[str, dict] = {}
+
+    @staticmethod
+    def load(inputs: list[str]) -> "PriorEdition":
+        """Returns the prior edition read from output files or directories"""
+
+        edition = PriorEdition()
+
+        for record in read_outputs(inputs):
+            edition.add(record)
+
+        logger.info("Prior edition with %d text blocks", len(edition.results))
+
+        return edition
+
+    def add(self, record: dict):
+        content = record.get("content") or []
+
+        if record.get("status") != None:
+            return
+
+        for output in content:
+            hash = output.get("hash")
+
+            # Outputs of earlier versions lack the hash. Whether a block is
+            # furniture depends on the other pages of the run.
+            if hash != None:
+                self.results[hash] = {key:value for (key, value) in output.items()
+                                      if key not in ("rect", "hash", "furniture")}
+
+        for hash in record.get("discarded") or []:
+            self.results[hash] = {}
+
+        metadata = record.get("metadata") or {}
+        date_block = metadata.get("date_block")
+
+        if date_block in self.results:
+            self.results[date_block]["date"] = metadata["date"]
+
+    def match(self, hashes: list[str]) -> Optional[str]:
+        """Returns the first of the block_hashes of a block known to the edition"""
+
+        return next((hash for hash in hashes if hash in self.results), None)
+
+    def get(self, hash: str) -> Optional[dict]:
+        """Returns a copy of the result of the block or None if it is new"""
+
+        result = self.results.get(hash)
+
+        return copy.deepcopy(result) if result != None else None
+
+class ChangeReport:
+    """Records which text blocks of a run were reused from the prior edition
+
+    Blocks of the prior edition no block of the run matched are reported as
+    removed.
+    """
+
+    def __init__(self, prior: PriorEdition):
+        self.prior = prior
+        self.lock = Lock()
+        self.pages: list[dict] = []
+        self.seen: set[str] = set()
+        self.reused = 0
+        self.analysed = 0
+
+    @staticmethod
+    def path_for(output: str) -> str:
+        """Returns the path of the report next to the output"""
+
+        return os.path.normpath(output) + ".changes.json"
+
+    def add(
+            self,
+            file: Optional[str],
+            page: Optional[int],
+            reused: list[tuple[int, str, str]],
+            analysed: list[tuple[int, str, str]]):
+        """Records the blocks reused and analysed on a page
+
+        Reused blocks are given as (rect, hash, hash of the prior block) and
+        analysed ones as (rect, hash, text).
+        """
+
+        with self.lock:
+            self.reused += len(reused)
+            self.analysed += len(analysed)
+            self.seen.update(previous for (_, _, previous) in reused)
+            self.seen.update(hash for (_, hash, _) in analysed)
+            self.pages.append({
+                "file": file,
+                "page": page,
+                "reused": [{"rect": rect, "hash": hash, "previous": previous}
+                           for (rect, hash, previous) in reused],
+                "analysed": [{"rect": rect, "hash": hash, "text": text}
+                             for (rect, hash, text) in analysed],
+            })
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            removed = [hash for hash in self.prior.results if hash not in self.seen]
+            pages = sorted(self.pages, key=lambda p: (p["file"] or "", p["page"] or 0))
+
+            return {
+                "reused": self.reused,
+                "analysed": self.analysed,
+                "removed": len(removed),
+                "removed_blocks": removed,
+                "pages": pages,
+            }
+
+    def summary(self) -> str:
+        report = self.to_dict()
+        return (f"{report['reused']} text blocks reused, {report['analysed']} analysed, "
+                f"{report['removed']} removed")
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=2)
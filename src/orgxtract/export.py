@@ -0,0 +1,429 @@
+import json
+import logging
+import os
+import sqlite3
+from threading import Lock, Timer
+from typing import Iterator, Optional, Protocol, TextIO
+
+from orgxtract.corpus import discover
+
+logger = logging.getLogger(__package__)
+
+# Columns of the tables written by the bulk formats. Every row carries the
+# file, page and index of the rectangle (text block) it was extracted from.
+PAGE_COLUMNS = ("file", "page", "date", "status", "partial_geometry")
+UNIT_COLUMNS = ("file", "page", "rect", "type", "name", "responsibilities", "text")
+PERSON_COLUMNS = ("file", "page", "rect", "person", "name", "position_type",
+                  "salutation", "title", "contact")
+
+class RecordWriter(Protocol):
+    """Writes page records, see JsonLinesWriter and BULK_FORMATS
+
+    Writers can be shared by threads. Writing after close raises an error
+    instead of dropping the record.
+    """
+
+    def write(self, record: dict): ...
+
+    def flush(self): ...
+
+    def close(self): ...
+
+class JsonLinesWriter:
+    """Writes records as JSON Lines while a run is in progress
+
+    Records are written through a buffer. A timer flushes it at most
+    flush_interval seconds after a record was written, so the output can be
+    followed with tools like tail even if no further record comes. The
+    writer can be shared by threads.
+    """
+
+    def __init__(self, file: TextIO, flush_interval: float = 1.0, closes_file: bool = True):
+        self.file = file
+        self.flush_interval = flush_interval
+        self.closes_file = closes_file
+        self.lock = Lock()
+        # Pending flush of the records written since the last flush
+        self.timer: Optional[Timer] = None
+
+    @staticmethod
+    def open(path: str, flush_interval: float = 1.0) -> "JsonLinesWriter":
+        file = open(path, "w", encoding="utf-8", buffering=1 << 16)
+        return JsonLinesWriter(file, flush_interval)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+        with self.lock:
+            self.file.write(line)
+            self.file.write("\n")
+
+            if self.timer == None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer != None:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        self.flush()
+
+        if self.closes_file:
+            with self.lock:
+                self.file.close()
+
+def page_record(file: str, page: int, result) -> dict:
+    """Returns the record of a page result tagged with the file and page"""
+
+    record = {"file": file, "page": page}
+
+    if isinstance(result, dict):
+        record.update(result)
+    else:
+        record["content"] = result
+
+    return record
+
+def flatten_record(record: dict) -> tuple[tuple, list[tuple], list[tuple]]:
+    """Returns the page row and the unit and person rows of a page record
+
+    Lists like responsibilities are stored as JSON text.
+    """
+
+    file = record.get("file")
+    page = record.get("page")
+    metadata = record.get("metadata") or {}
+    partial_geometry = record.get("partial_geometry")
+
+    page_row = (file, page, metadata.get("date"), record.get("status"),
+                partial_geometry if partial_geometry != None else False)
+    unit_rows = []
+    person_rows = []
+
+    for (index, unit) in enumerate(record.get("content") or []):
+        # Outputs of earlier versions lack the rect index.
+        rect = unit.get("rect", index)
+        responsibilities = unit.get("responsibilities")
+
+        if responsibilities != None:
+            responsibilities = json.dumps(responsibilities, ensure_ascii=False)
+
+        unit_rows.append((file, page, rect, unit.get("type"), unit.get("name"),
+                          responsibilities, unit.get("text")))
+
+        for (person_index, person) in enumerate(unit.get("persons") or []):
+            person_rows.append((file, page, rect, person_index, person.get("name"),
+                                person.get("positionType"), person.get("salutation"),
+                                person.get("title"), person.get("contact")))
+
+    return (page_row, unit_rows, person_rows)
+
+class SqliteWriter:
+    """Writes page records flattened into the tables of an SQLite database
+
+    The tables are pages, units and persons (see the *_COLUMNS). Records are
+    buffered and inserted in a single transaction per batch of batch_size
+    pages. A page written again replaces its rows, so runs can be repeated
+    into the same database. The writer can be shared by threads.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        self.batch_size = batch_size
+        self.lock = Lock()
+        # The page, unit and person rows of the batch by (file, page), only
+        # the last record of a page written twice is kept
+        self.batch: dict[tuple, tuple[tuple, list[tuple], list[tuple]]] = {}
+        self.is_closed = False
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    file TEXT, page INTEGER, date TEXT, status TEXT, partial_geometry INTEGER,
+                    PRIMARY KEY (file, page));
+                CREATE TABLE IF NOT EXISTS units (
+                    file TEXT, page INTEGER, rect INTEGER, type TEXT, name TEXT,
+                    responsibilities TEXT, text TEXT);
+                CREATE TABLE IF NOT EXISTS persons (
+                    file TEXT, page INTEGER, rect INTEGER, person INTEGER, name TEXT,
+                    position_type TEXT, salutation TEXT, title TEXT, contact TEXT);
+                CREATE INDEX IF NOT EXISTS units_page ON units (file, page);
+                CREATE INDEX IF NOT EXISTS persons_page ON persons (file, page);
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def write(self, record: dict):
+        rows = flatten_record(record)
+        (file, page, *_) = rows[0]
+
+        with self.lock:
+            check_open(self)
+            # The page moves to the end, after the pages written before.
+            self.batch.pop((file, page), None)
+            self.batch[(file, page)] = rows
+
+            if self.batch_size <= len(self.batch):
+                self.insert()
+
+    def flush(self):
+        with self.lock:
+            self.insert()
+
+    def close(self):
+        with self.lock:
+            if self.is_closed:
+                return
+
+            self.is_closed = True
+            self.insert()
+            self.connection.close()
+
+    def insert(self):
+        if len(self.batch) == 0:
+            return
+
+        keys = list(self.batch.keys())
+        rows = self.batch.values()
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM units WHERE file = ? AND page = ?", keys)
+            self.connection.executemany("DELETE FROM persons WHERE file = ? AND page = ?", keys)
+            self.connection.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                        [page_row for (page_row, _, _) in rows])
+            self.connection.executemany("INSERT INTO units VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [row for (_, unit_rows, _) in rows for row in unit_rows])
+            self.connection.executemany("INSERT INTO persons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [row for (_, _, person_rows) in rows for row in person_rows])
+
+        self.batch.clear()
+
+class ParquetWriter:
+    """Writes page records flattened into Parquet files
+
+    The directory at path receives pages.parquet, units.parquet and
+    persons.parquet with the same columns as the SQLite tables. Every batch
+    of batch_size pages is written as a row group. It requires pyarrow.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as error:
+            raise ImportError("The parquet format requires pyarrow (pip install pyarrow)") from error
+
+        self.pyarrow = pyarrow
+        self.batch_size = batch_size
+        self.lock = Lock()
+        self.pages: list[tuple] = []
+        self.units: list[tuple] = []
+        self.persons: list[tuple] = []
+        self.is_closed = False
+
+        string = pyarrow.string()
+        integer = pyarrow.int32()
+        self.schemas = {
+            "pages": pyarrow.schema([("file", string), ("page", integer), ("date", string),
+                                     ("status", string), ("partial_geometry", pyarrow.bool_())]),
+            "units": pyarrow.schema([("file", string), ("page", integer), ("rect", integer),
+                                     ("type", string), ("name", string),
+                                     ("responsibilities", string), ("text", string)]),
+            "persons": pyarrow.schema([("file", string), ("page", integer), ("rect", integer),
+                                       ("person", integer), ("name", string),
+                                       ("position_type", string), ("salutation", string),
+                                       ("title", string), ("contact", string)]),
+        }
+
+        os.makedirs(path, exist_ok=True)
+
+        self.writers = {name:pyarrow.parquet.ParquetWriter(os.path.join(path, name + ".parquet"),
+                                                           schema)
+                        for (name, schema) in self.schemas.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def write(self, record: dict):
+        (page_row, unit_rows, person_rows) = flatten_record(record)
+
+        with self.lock:
+            check_open(self)
+            self.pages.append(page_row)
+            self.units.extend(unit_rows)
+            self.persons.extend(person_rows)
+
+            if self.batch_size <= len(self.pages):
+                self.write_row_groups()
+
+    def flush(self):
+        with self.lock:
+            self.write_row_groups()
+
+    def close(self):
+        with self.lock:
+            if self.is_closed:
+                return
+
+            self.is_closed = True
+            self.write_row_groups()
+
+            for writer in self.writers.values():
+                writer.close()
+
+    def write_row_groups(self):
+        if len(self.pages) == 0:
+            return
+
+        for (name, rows) in (("pages", self.pages), ("units", self.units), ("persons", self.persons)):
+            schema = self.schemas[name]
+            # Rows are transposed into columns.
+            columns = list(zip(*rows)) if 0 < len(rows) else [()] * len(schema)
+            table = self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, type=field.type)
+                 for (column, field) in zip(columns, schema)],
+                schema=schema)
+
+            self.writers[name].write_table(table)
+            rows.clear()
+
+def check_open(writer: SqliteWriter | ParquetWriter):
+    if writer.is_closed:
+        raise ValueError("write to closed writer")
+
+# The formats writing all records of a run to a single target
+BULK_FORMATS = {"sqlite": SqliteWriter, "parquet": ParquetWriter}
+
+def open_bulk_writer(format: str, path: str) -> RecordWriter:
+    """Returns the writer of the bulk format writing to path"""
+
+    return BULK_FORMATS[format](path)
+
+def export_outputs(inputs: list[str], writer: RecordWriter):
+    """Writes the records of JSON and JSON Lines outputs to a bulk writer
+
+    See read_outputs for the inputs.
+    """
+
+    for record in read_outputs(inputs):
+        writer.write(record)
+
+def read_outputs(inputs: list[str]) -> Iterator[dict]:
+    """Returns an iterator yielding the page records of JSON and JSON Lines outputs
+
+    Inputs are output files or directories searched recursively like in
+    merge_outputs. JSON outputs do not record their input, which is why the
+    file of their records is the path of the output without extension.
+    """
+
+    for input in inputs:
+        if os.path.isdir(input):
+            paths = [os.path.join(input, path)
+                     for path in discover(input,
+                                          recursive=True,
+                                          include=["*.json", "*.jsonl"],
+                                          exclude=["*.manifest.json", "*.changes.json"])]
+        else:
+            paths = [input]
+
+        for path in paths:
+            if path.endswith(".jsonl"):
+                yield from read_json_lines(path)
+            else:
+                with open(path, "r", encoding="utf-8") as file:
+                    content = json.load(file)
+
+                (name, _) = os.path.splitext(path)
+
+                for (page, result) in sorted(content.items(), key=lambda item: int(item[0])):
+                    yield page_record(name, int(page), result)
+
+            logger.info("Read %s", path)
+
+def read_json_lines(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.isspace():
+                yield json.loads(line)
+
+def merge_outputs(inputs: list[str], output: str):
+    """Merges the outputs of several runs (e.g. shards) into one output
+
+    Inputs are output files or output directories, which are searched
+    recursively for .json and .jsonl files. Files with the same path
+    relative to their input are merged. For JSON the pages of all files are
+    combined, for JSON Lines the records are concatenated and sorted by
+    file and page. If all inputs are files, output is the merged file,
+    otherwise the directory the merged files are written to.
+    """
+
+    groups: dict[str, list[str]] = {}
+    is_directory = any(os.path.isdir(input) for input in inputs)
+
+    for input in inputs:
+        if not is_directory:
+            groups.setdefault(output, []).append(input)
+        elif os.path.isdir(input):
+            paths = discover(input,
+                             recursive=True,
+                             include=["*.json", "*.jsonl"],
+                             exclude=["*.manifest.json", "*.changes.json"])
+
+            for path in paths:
+                groups.setdefault(path, []).append(os.path.join(input, path))
+        else:
+            groups.setdefault(os.path.basename(input), []).append(input)
+
+    for (path, sources) in groups.items():
+        target = os.path.join(output, path) if is_directory else output
+        directory = os.path.dirname(target)
+
+        if 0 < len(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        if sources[0].endswith(".jsonl"):
+            records = []
+
+            for source in sources:
+                records.extend(read_json_lines(source))
+
+            records.sort(key=lambda r: (r.get("file", ""), r.get("page", 0)))
+
+            with JsonLinesWriter.open(target) as writer:
+                for record in records:
+                    writer.write(record)
+        else:
+            content = {}
+
+            for source in sources:
+                with open(source, "r", encoding="utf-8") as file:
+                    content.update(json.load(file))
+
+            content = dict(sorted(content.items(), key=lambda item: int(item[0])))
+
+            with open(target, "w", encoding="utf-8") as file:
+                json.dump(content, file, ensure_ascii=False, separators=(",", ":"))
+
+        logger.info("Merged %d files into %s", len(sources), target)
@@ -0,0 +1,142 @@
+import hashlib
+from importlib import metadata, resources
+import json
+import logging
+import os
+from threading import Lock
+import time
+from typing import Optional
+
+from orgxtract import data
+
+logger = logging.getLogger(__package__)
+
+# The data files changing the extraction result. See TextPipeline.
+DATA_FILES = [
+    "schema.json",
+    "special_cases.jsonl",
+    "org_types",
+    "per_positions",
+    "per_positions_abbr",
+    "per_salutations",
+    "per_titles",
+]
+
+class Manifest:
+    """Records which inputs have been processed with which pipeline
+
+    The manifest stores the content hash of every processed input together
+    with the fingerprint of the pipeline (version, data files, model and
+    options). An input is only processed again if its content, the
+    fingerprint or its output changed. It is stored as JSON and written
+    atomically, so an interrupted run keeps the inputs done so far.
+    """
+
+    def __init__(self, path: str, fingerprint: dict, save_interval: float = 30.0):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.save_interval = save_interval
+        self.files: dict[str, dict] = {}
+        self.lock = Lock()
+        # Serialises the saves of worker threads and the final save, which
+        # share the temporary file
+        self.save_lock = Lock()
+        self.last_save = time.monotonic()
+        self.processed = 0
+        self.skipped = 0
+
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+
+            if manifest.get("fingerprint") == fingerprint:
+                self.files = manifest.get("files", {})
+            else:
+                logger.info("Pipeline changed, all inputs of %s are reprocessed", path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            logger.warning("Manifest %s ignored: %s(%s)", path, type(error).__name__, error)
+
+    @staticmethod
+    def path_for(output: str) -> str:
+        """Returns the path of the manifest next to the output"""
+
+        return os.path.normpath(output) + ".manifest.json"
+
+    def is_current(self, input: str, digest: str, output: str) -> bool:
+        with self.lock:
+            entry = self.files.get(input)
+
+        return (entry != None
+                and entry.get("hash") == digest
+                and entry.get("output") == output
+                and os.path.exists(output))
+
+    def skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def update(self, input: str, digest: str, output: str):
+        with self.lock:
+            self.files[input] = {"hash": digest, "output": output}
+            self.processed += 1
+
+            is_due = self.save_interval <= time.monotonic() - self.last_save
+
+        if is_due:
+            self.save()
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                content = {"fingerprint": self.fingerprint, "files": dict(self.files)}
+                self.last_save = time.monotonic()
+
+            temporary = self.path + ".tmp"
+
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(content, file, ensure_ascii=False, separators=(",", ":"))
+
+            os.replace(temporary, self.path)
+
+def fingerprint(data_path: Optional[str], **options) -> dict:
+    """Returns the fingerprint of a pipeline configuration
+
+    It contains the package version, the hashes of the data files and the
+    options, e.g. the name of the model.
+    """
+
+    try:
+        version = metadata.version("orgxtract")
+    except metadata.PackageNotFoundError:
+        version = None
+
+    content = {
+        "version": version,
+        "data": {name:hash_data_file(data_path, name) for name in DATA_FILES},
+        "options": options,
+    }
+
+    # Normalised to compare equal with a fingerprint loaded from JSON.
+    return json.loads(json.dumps(content))
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def hash_data_file(data_path: Optional[str], name: str) -> str:
+    # Files missing in the data path fall back to the package data like the
+    # text pipeline does.
+    if data_path != None:
+        try:
+            return hash_file(os.path.join(data_path, name))
+        except OSError:
+            pass
+
+    return hashlib.sha256((resources.files(data) / name).read_bytes()).hexdigest()
@@ -1,9 +1,14 @@
-from typing import Iterator
+import asyncio
+from collections import deque
+from concurrent.futures import Executor
+import os
+from typing import AsyncIterator, Iterable, Iterator, Optional
 
 import pymupdf
 from pymupdf import Page, TEXTFLAGS_RAWDICT, TEXT_PRESERVE_IMAGES
 
 from orgxtract.drawing import Drawing, Line, Point, Rect, TextSpan
+from orgxtract.telemetry import timed
 
 def open(path: str) -> Iterator[Drawing]:
     """Returns an iterator yielding a Drawing for each PDF page
@@ -12,11 +17,104 @@ def open(path: str) -> Iterator[Drawing]:
     FileNotFoundError or RuntimeError.
     """
 
-    pdf = pymupdf.open(path, filetype="pdf")
+    for (_index, drawing) in open_pages(path):
+        yield drawing
 
-    for page in pdf:
-        yield extract_drawing(page)
+def open_pages(
+        source: str | bytes,
+        pages: Optional[Iterable[int]] = None) -> Iterator[tuple[int, Drawing]]:
+    """Returns an iterator yielding the page index and Drawing of PDF pages
 
+    The source is either the path or the content of a PDF. If pages is given,
+    only the pages with those indices are extracted. Otherwise it behaves
+    like open.
+    """
+
+    pdf = open_document(source)
+
+    if pages == None:
+        pages = range(0, pdf.page_count)
+
+    for index in pages:
+        yield (index, extract_drawing(pdf[index]))
+
+async def aopen(path: str, executor: Optional[Executor] = None) -> AsyncIterator[Drawing]:
+    """Returns an async iterator yielding a Drawing for each PDF page
+
+    The pages are extracted in executor, see aopen_pages.
+    """
+
+    async for (_index, drawing) in aopen_pages(path, executor=executor):
+        yield drawing
+
+async def aopen_pages(
+        source: str | bytes,
+        pages: Optional[Iterable[int]] = None,
+        executor: Optional[Executor] = None,
+        max_pending: Optional[int] = None) -> AsyncIterator[tuple[int, Drawing]]:
+    """Returns an async iterator yielding the page index and Drawing of PDF pages
+
+    Every page is extracted by extract_page in executor, which can be a
+    ProcessPoolExecutor since the PDF is opened by the worker. By default
+    the thread pool of the event loop is used. At most max_pending pages
+    (default: amount of CPUs) are extracted ahead of the consumer, so a slow
+    consumer holds back the extraction. The pages are yielded in order and
+    the pending pages are cancelled when the iteration is left early.
+
+    A PDF given as content is sent to every worker, so pass a path to a
+    process pool.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    if pages == None:
+        pages = range(0, await loop.run_in_executor(executor, page_count, source))
+
+    if max_pending == None:
+        max_pending = os.cpu_count() or 1
+
+    pending = deque()
+    indices = iter(pages)
+
+    try:
+        while True:
+            for index in indices:
+                pending.append((index, loop.run_in_executor(executor, extract_page, source, index)))
+
+                if max_pending <= len(pending):
+                    break
+
+            if len(pending) == 0:
+                return
+
+            (index, future) = pending.popleft()
+            yield (index, await future)
+    finally:
+        for (_index, future) in pending:
+            future.cancel()
+
+def extract_page(source: str | bytes, index: int) -> Drawing:
+    """Returns the Drawing of the page at index of the PDF
+
+    It opens the PDF itself, so it can run in a worker process.
+    """
+
+    with open_document(source) as pdf:
+        return extract_drawing(pdf[index])
+
+def page_count(source: str | bytes) -> int:
+    """Returns the number of pages of the PDF without extracting them"""
+
+    with open_document(source) as pdf:
+        return pdf.page_count
+
+def open_document(source: str | bytes) -> pymupdf.Document:
+    if isinstance(source, bytes):
+        return pymupdf.open(stream=source, filetype="pdf")
+
+    return pymupdf.open(source, filetype="pdf")
+
+@timed("pdf_extract_drawing_seconds")
 def extract_drawing(page: Page) -> Drawing:
     def generate_text_spans(blocks):
         for block in blocks:
@@ -73,6 +171,12 @@ def extract_drawing(page: Page) -> Drawing:
             match item[0]:
                 case "re":
                     rects.append(Rect._make(item[1]))
+                case "qu" if is_axis_aligned(item[1]):
+                    # pymupdf reports four connected lines forming a box as
+                    # quad.
+                    (x0, y0) = min(item[1])
+                    (x1, y1) = max(item[1])
+                    rects.append(Rect(x0, y0, x1, y1))
                 case "l":
                     p0 = Point._make(item[1])
                     p1 = Point._make(item[2])
@@ -91,3 +195,11 @@ def extract_drawing(page: Page) -> Drawing:
 
     return Drawing(page.rect.width, page.rect.height,
                    rects, lines, text_spans)
+
+def is_axis_aligned(points: tuple) -> bool:
+    """Returns whether the four points are the corners of an axis-aligned box"""
+
+    xs = {x for (x, _) in points}
+    ys = {y for (_, y) in points}
+
+    return len(xs) == 2 and len(ys) == 2 and len(set(points)) == 4
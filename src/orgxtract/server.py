@@ -0,0 +1,143 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import sys
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from typing import Optional
+
+from orgxtract.cli import Context, Furniture, submit_pages
+import orgxtract.pdf as pdf
+
+logger = logging.getLogger(__package__)
+
+class ExtractionServer:
+    """Extracts uploaded PDFs with the warm pipeline of a Context
+
+    The pipeline, the spaCy model and the LLM client are loaded once. The
+    pages of concurrent requests share the page workers and are batched by
+    the text stage.
+    """
+
+    def __init__(self, context: Context):
+        self.context = context
+        self.lock = Lock()
+        self.requests = 0
+        self.pages = 0
+
+    def extract(self, data: bytes) -> dict:
+        """Returns the same content as written by the CLI for a file"""
+
+        with self.lock:
+            self.requests += 1
+
+        try:
+            furniture = Furniture()
+            futures = submit_pages(self.context, pdf.open_pages(data), furniture=furniture)
+
+            with self.lock:
+                self.pages += len(futures)
+
+            try:
+                content = {index:future.result() for (future, index) in futures.items()}
+                furniture.mark(content)
+                return content
+            finally:
+                with self.lock:
+                    self.pages -= len(futures)
+        finally:
+            with self.lock:
+                self.requests -= 1
+
+    def health(self) -> tuple[int, dict]:
+        text_processing = self.context.text_processing
+
+        if text_processing != None and text_processing.done():
+            return (503, {"status": "failed"})
+
+        if not self.context.ready.is_set():
+            return (503, {"status": "starting"})
+
+        return (200, {"status": "ok"})
+
+    def queue(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "pages": self.pages,
+                "text_queue": self.context.task_queue.qsize(),
+            }
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def serve(context: Context, host: str, port: int, socket_path: Optional[str] = None):
+    """Serves the HTTP API until interrupted
+
+    POST /extract expects a PDF as body and responds with the extracted
+    content. GET /health and GET /queue report the state of the pipeline
+    and the amount of requests and pages in flight.
+    """
+
+    server = ExtractionServer(context)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(*server.health())
+            elif self.path == "/queue":
+                self.send_json(200, server.queue())
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/extract":
+                self.send_json(404, {"error": "not found"})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+
+            try:
+                self.send_json(200, server.extract(data))
+            except (RuntimeError, ValueError) as error:
+                # pymupdf raises a RuntimeError for broken PDFs.
+                self.send_json(400, {"error": f"{type(error).__name__}({error})"})
+            except Exception as error:
+                logger.error("Extraction failed: %s(%s)", type(error).__name__, error)
+                self.send_json(500, {"error": type(error).__name__})
+
+        def send_json(self, status: int, content: dict):
+            body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # Clients of Unix sockets do not have an address.
+            return self.client_address[0] if self.client_address else socket_path
+
+        def log_message(self, format, *args):
+            logger.info("%s %s", self.address_string(), format % args)
+
+    if socket_path != None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        http_server = UnixHTTPServer(socket_path, Handler)
+        print(f"Serving on {socket_path}", file=sys.stderr)
+    else:
+        http_server = ThreadingHTTPServer((host, port), Handler)
+        print(f"Serving on http://{host}:{port}", file=sys.stderr)
+
+    with http_server:
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,418 @@
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import Executor, Future
+from functools import partial
+from itertools import accumulate, chain
+from multiprocessing.shared_memory import SharedMemory
+import os
+from typing import Iterable, Iterator, NamedTuple, Optional, Protocol, Self
+
+from orgxtract.deadline import Deadline
+from orgxtract.document import Document
+from orgxtract.drawing import Drawing, Line, Point, Rect, TextSpan
+
+# Sections start at multiples of the largest item size (float64, int64).
+ALIGNMENT = 8
+
+class Budget(Protocol):
+    """Admits pages, see PageBudget of the CLI"""
+
+    def acquire(self): ...
+
+    def try_acquire(self) -> bool: ...
+
+    def release(self): ...
+
+class SharedHandle(NamedTuple):
+    """Identifies a Drawing or Document in a shared memory block
+
+    It is all that is sent to another process, which attaches the block by
+    its name. The sections map the name of every array in the block to its
+    byte offset and amount of items.
+    """
+
+    name: str
+    width: float
+    height: float
+    is_partial: bool
+    sections: dict[str, tuple[int, int]]
+
+class RectView(Sequence):
+    """Rects read on access from float64 values x0, y0, x1, y1"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: memoryview):
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values) // 4
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        v = self.values
+        i = 4 * check_index(index, len(self))
+
+        return Rect(v[i], v[i + 1], v[i + 2], v[i + 3])
+
+    def __iter__(self) -> Iterator[Rect]:
+        values = iter(self.values)
+        return map(Rect, values, values, values, values)
+
+class LineView(Sequence):
+    """Lines read on access from float64 values p0.x, p0.y, p1.x, p1.y"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: memoryview):
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values) // 4
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        v = self.values
+        i = 4 * check_index(index, len(self))
+
+        return Line(Point(v[i], v[i + 1]), Point(v[i + 2], v[i + 3]))
+
+    def __iter__(self) -> Iterator[Line]:
+        values = iter(self.values)
+
+        for (x0, y0, x1, y1) in zip(values, values, values, values):
+            yield Line(Point(x0, y0), Point(x1, y1))
+
+class TextSpanView(Sequence):
+    """Text spans read on access from their bboxes and a UTF-8 text arena
+
+    The text of span i are the bytes from offsets[i] to offsets[i + 1].
+    """
+
+    __slots__ = ("bboxes", "offsets", "text")
+
+    def __init__(self, bboxes: memoryview, offsets: memoryview, text: memoryview):
+        self.bboxes = RectView(bboxes)
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self) -> int:
+        return len(self.bboxes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        i = check_index(index, len(self))
+
+        return TextSpan(self.bboxes[i], str(self.text[self.offsets[i]:self.offsets[i + 1]], "utf-8"))
+
+    def __iter__(self) -> Iterator[TextSpan]:
+        text = self.text
+        offsets = self.offsets
+
+        for (i, bbox) in enumerate(self.bboxes):
+            yield TextSpan(bbox, str(text[offsets[i]:offsets[i + 1]], "utf-8"))
+
+def check_index(index: int, length: int) -> int:
+    if index < 0:
+        index += length
+
+    if not (0 <= index < length):
+        raise IndexError("index out of range")
+
+    return index
+
+class Packer:
+    """Collects the arrays of a block and writes them to shared memory"""
+
+    def __init__(self):
+        self.sections: dict[str, tuple[int, int]] = {}
+        self.parts: list[tuple[int, memoryview]] = []
+        self.size = 0
+
+    def add(self, name: str, values: array | bytes):
+        data = memoryview(values).cast("B")
+        offset = -(-self.size // ALIGNMENT) * ALIGNMENT
+
+        self.sections[name] = (offset, len(values))
+        self.parts.append((offset, data))
+        self.size = offset + len(data)
+
+    def add_texts(self, name: str, texts: Iterable[str]):
+        """Adds the texts as UTF-8 arena and the offsets of every text"""
+
+        encoded = [text.encode("utf-8") for text in texts]
+
+        self.add(f"{name}_offsets", array("q", chain((0,), accumulate(map(len, encoded)))))
+        self.add(name, b"".join(encoded))
+
+    def write(self) -> SharedMemory:
+        shm = SharedMemory(create=True, size=max(1, self.size))
+
+        for (offset, data) in self.parts:
+            shm.buf[offset:offset + len(data)] = data
+
+        return shm
+
+def pack_geometry(packer: Packer, rects: Iterable[Rect], lines: Iterable[Line], text_spans: Sequence[TextSpan]):
+    packer.add("rects", array("d", chain.from_iterable(rects)))
+    packer.add("lines", array("d", chain.from_iterable(chain.from_iterable(lines))))
+    packer.add("span_bboxes", array("d", chain.from_iterable(bbox for (bbox, _) in text_spans)))
+    packer.add_texts("span_text", (text for (_, text) in text_spans))
+
+class SharedGeometry:
+    """A shared memory block holding the geometry of a page
+
+    The process creating the block closes it after sending the handle, the
+    receiving process attaches it by the handle, reads the views and finally
+    closes and unlinks it. The views returned by the block are only valid
+    until it is closed.
+    """
+
+    def __init__(self, shm: SharedMemory, handle: SharedHandle):
+        self.shm = shm
+        self.handle = handle
+        self.views: list[memoryview] = []
+        self.is_released = False
+
+    @classmethod
+    def attach(cls, handle: SharedHandle) -> Self:
+        return cls(SharedMemory(handle.name), handle)
+
+    def section(self, name: str, format: str) -> memoryview:
+        """Returns a view of the items of the section without copying"""
+
+        (offset, count) = self.handle.sections[name]
+        size = count * array(format).itemsize
+        view = self.shm.buf[offset:offset + size]
+        items = view.cast(format)
+
+        self.views.append(view)
+        self.views.append(items)
+
+        return items
+
+    def geometry(self) -> tuple[RectView, LineView, TextSpanView]:
+        return (RectView(self.section("rects", "d")),
+                LineView(self.section("lines", "d")),
+                TextSpanView(self.section("span_bboxes", "d"),
+                             self.section("span_text_offsets", "q"),
+                             self.section("span_text", "B")))
+
+    def close(self):
+        """Releases the views and unmaps the block"""
+
+        for view in reversed(self.views):
+            view.release()
+
+        self.views.clear()
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the block once all processes closed it"""
+
+        self.shm.unlink()
+
+    def release(self):
+        """Closes and unlinks the block on the receiving side once"""
+
+        if not self.is_released:
+            self.is_released = True
+            self.close()
+            self.unlink()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SharedDrawing(SharedGeometry):
+    """A Drawing in shared memory, see SharedGeometry"""
+
+    @staticmethod
+    def create(drawing: Drawing) -> "SharedDrawing":
+        packer = Packer()
+        pack_geometry(packer, drawing.rects, drawing.lines, drawing.text_spans)
+        shm = packer.write()
+
+        return SharedDrawing(shm, SharedHandle(shm.name, drawing.width, drawing.height,
+                                               False, packer.sections))
+
+    def drawing(self) -> Drawing:
+        """Returns the Drawing with views of the block as lists"""
+
+        (rects, lines, text_spans) = self.geometry()
+
+        return Drawing(self.handle.width, self.handle.height, rects, lines, text_spans)
+
+class SharedDocument(SharedGeometry):
+    """A Document in shared memory, see SharedGeometry
+
+    The text blocks and contents are stored as arrays next to the geometry
+    but copied into dicts by document, they are small compared to it.
+    """
+
+    @staticmethod
+    def create(document: Document) -> "SharedDocument":
+        packer = Packer()
+        pack_geometry(packer, document.rects, document.lines, document.text_spans)
+
+        blocks = document.text_blocks
+        packer.add("block_keys", array("q", blocks.keys()))
+        packer.add("block_offsets", array("q", chain((0,), accumulate(map(len, blocks.values())))))
+        packer.add("block_spans", array("q", chain.from_iterable(blocks.values())))
+
+        packer.add("content_keys", array("q", document.text_contents.keys()))
+        packer.add_texts("content_text", document.text_contents.values())
+        shm = packer.write()
+
+        return SharedDocument(shm, SharedHandle(shm.name, document.width, document.height,
+                                                document.is_partial, packer.sections))
+
+    def document(self) -> Document:
+        """Returns the Document with views of the block as lists"""
+
+        (rects, lines, text_spans) = self.geometry()
+
+        keys = self.section("block_keys", "q")
+        offsets = self.section("block_offsets", "q")
+        spans = self.section("block_spans", "q")
+        text_blocks = {key:spans[offsets[n]:offsets[n + 1]].tolist()
+                       for (n, key) in enumerate(keys)}
+
+        keys = self.section("content_keys", "q")
+        offsets = self.section("content_text_offsets", "q")
+        text = self.section("content_text", "B")
+        text_contents = {key:str(text[offsets[n]:offsets[n + 1]], "utf-8")
+                         for (n, key) in enumerate(keys)}
+
+        return Document(self.handle.width, self.handle.height,
+                        rects, lines, text_spans,
+                        text_blocks, text_contents, self.handle.is_partial)
+
+def extract_document(
+        source: str | bytes,
+        index: int,
+        tolerance: Optional[float] = 1.0,
+        timeout: Optional[float] = None) -> SharedHandle:
+    """Extracts the Document of the page at index of the PDF to shared memory
+
+    It runs in a worker process, the block is left to the process attaching
+    the handle. A tolerance of None chooses the best tolerance and the
+    timeout (seconds) bounds the rectangle detection.
+    """
+
+    import orgxtract.pdf as pdf
+
+    drawing = pdf.extract_page(source, index)
+    deadline = Deadline.after(timeout)
+
+    if tolerance != None:
+        document = Document.extract(drawing, tolerance, deadline)
+    else:
+        document = Document.extract_best(drawing, deadline=deadline)
+
+    shared = SharedDocument.create(document)
+    shared.close()
+
+    return shared.handle
+
+def open_documents(
+        executor: Executor,
+        source: str | bytes,
+        pages: Optional[Iterable[int]] = None,
+        tolerance: Optional[float] = 1.0,
+        timeout: Optional[float] = None,
+        max_pending: Optional[int] = None,
+        budget: Optional[Budget] = None) -> Iterator[tuple[int, SharedDocument]]:
+    """Returns an iterator yielding the page index and SharedDocument of PDF pages
+
+    Every page is extracted by extract_document in executor, usually a
+    ProcessPoolExecutor. At most max_pending pages (default: amount of CPUs)
+    are extracted ahead of the consumer and the pages are yielded in order.
+    The consumer releases every yielded document. Pending pages are
+    cancelled or released when the iteration is left early.
+
+    With a budget every page is admitted before it is extracted. Only the
+    next page to yield waits for the budget, pages ahead of it are only
+    extracted while the budget admits them right away. The consumer
+    releases the budget of every yielded page once it is done.
+    """
+
+    if pages == None:
+        import orgxtract.pdf as pdf
+        pages = range(0, pdf.page_count(source))
+
+    if max_pending == None:
+        max_pending = os.cpu_count() or 1
+
+    pending = deque()
+    indices = iter(pages)
+    # The next page, which was not admitted yet
+    next_index = None
+
+    try:
+        while True:
+            while len(pending) < max_pending:
+                if next_index == None:
+                    next_index = next(indices, None)
+
+                    if next_index == None:
+                        break
+
+                if budget != None:
+                    if len(pending) == 0:
+                        budget.acquire()
+                    elif not budget.try_acquire():
+                        break
+
+                try:
+                    future = executor.submit(extract_document, source, next_index,
+                                             tolerance, timeout)
+                except BaseException:
+                    if budget != None:
+                        budget.release()
+
+                    raise
+
+                pending.append((next_index, future))
+                next_index = None
+
+            if len(pending) == 0:
+                return
+
+            (index, future) = pending.popleft()
+
+            try:
+                shared = SharedDocument.attach(future.result())
+            except BaseException:
+                if budget != None:
+                    budget.release()
+
+                raise
+
+            yield (index, shared)
+    finally:
+        for (_index, future) in pending:
+            if future.cancel():
+                if budget != None:
+                    budget.release()
+            else:
+                future.add_done_callback(partial(discard, budget=budget))
+
+def discard(future: Future, budget: Optional[Budget] = None):
+    """Releases the block of a finished extract_document nobody attached"""
+
+    try:
+        if not future.cancelled() and future.exception() == None:
+            SharedDocument.attach(future.result()).release()
+    finally:
+        if budget != None:
+            budget.release()
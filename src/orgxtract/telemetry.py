@@ -0,0 +1,354 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+from threading import Event, Lock, Thread
+import time
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+logger = logging.getLogger(__package__)
+
+T = TypeVar("T")
+
+# Upper bounds of histogram buckets for latencies (seconds) and other sizes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram:
+    """Counts observations in buckets like a Prometheus histogram"""
+
+    __slots__ = ("bounds", "buckets", "count", "sum", "min", "max")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if 0 < self.count else None,
+            "max": self.max if 0 < self.count else None,
+            "buckets": dict(zip([*map(str, self.bounds), "+Inf"], self.buckets)),
+        }
+
+class Metrics:
+    """A thread-safe registry of counters, gauges and histograms
+
+    Names ending with _seconds are histograms of latencies. Gauges are
+    functions evaluated when a snapshot is taken, e.g. to sample the length
+    of a queue.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.monotonic()
+        self.counters: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+
+            if histogram == None:
+                bounds = SECONDS_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS
+                histogram = Histogram(bounds)
+                self.histograms[name] = histogram
+
+            histogram.observe(value)
+
+    def gauge(self, name: str, function: Callable[[], float]):
+        with self.lock:
+            self.gauges[name] = function
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.counters.clear()
+            self.histograms.clear()
+            self.gauges.clear()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name:h.to_dict() for (name, h) in self.histograms.items()}
+            gauges = dict(self.gauges)
+            elapsed = time.monotonic() - self.start
+
+        return {
+            "elapsed_seconds": elapsed,
+            "counters": counters,
+            "gauges": {name:function() for (name, function) in gauges.items()},
+            "histograms": histograms,
+        }
+
+    def to_prometheus(self, prefix: str = "orgxtract") -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+
+        snapshot = self.snapshot()
+        lines = []
+
+        for (name, value) in snapshot["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"{prefix}_{name} {value}")
+
+        for (name, value) in snapshot["gauges"].items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+
+        for (name, histogram) in snapshot["histograms"].items():
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            total = 0
+
+            for (bound, count) in histogram["buckets"].items():
+                total += count
+                lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {total}')
+
+            lines.append(f"{prefix}_{name}_sum {histogram['sum']}")
+            lines.append(f"{prefix}_{name}_count {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the metrics as Prometheus text (.prom, .txt) or JSON"""
+
+        if path.endswith((".prom", ".txt")):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+
+        temporary = path + ".tmp"
+
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(content)
+
+        os.replace(temporary, path)
+
+class Tracer:
+    """Records spans as a timeline in the Chrome trace event format
+
+    The trace can be opened with Perfetto (ui.perfetto.dev) or
+    chrome://tracing. Every span carries the process and thread it ran in,
+    so waiting threads and bubbles between the stages become visible.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events: list[dict] = []
+        self.threads: set[int] = set()
+
+    def span(self, name: str, start: float, end: float, args: Optional[dict] = None):
+        """Records a span with perf_counter timestamps"""
+
+        tid = threading.get_native_id()
+        event = {
+            "name": name,
+            "cat": name.partition("_")[0],
+            "ph": "X",
+            "ts": (start - self.start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": tid,
+        }
+
+        if args:
+            event["args"] = args
+
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                })
+
+            self.events.append(event)
+
+    def summary(self) -> dict:
+        """Returns the count, total, mean and max duration (ms) of each span"""
+
+        stages: dict[str, dict] = {}
+
+        with self.lock:
+            events = [e for e in self.events if e["ph"] == "X"]
+
+        for event in events:
+            stage = stages.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+            stage["count"] += 1
+            stage["total"] += event["dur"] / 1e3
+            stage["max"] = max(stage["max"], event["dur"] / 1e3)
+
+        for stage in stages.values():
+            stage["mean"] = stage["total"] / stage["count"]
+
+        return dict(sorted(stages.items(), key=lambda item: -item[1]["total"]))
+
+    def write(self, path: str):
+        with self.lock:
+            events = list(self.events)
+
+        content = {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"stages": self.summary()},
+        }
+
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(content, file, separators=(",", ":"))
+
+# The metrics of the process, which all stages report to
+metrics = Metrics()
+# Set while a trace is recorded, see start_tracing
+tracer: Optional[Tracer] = None
+
+def start_tracing() -> Tracer:
+    """Starts recording the spans of all stages"""
+
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+def stop_tracing() -> Optional[Tracer]:
+    global tracer
+    (stopped, tracer) = (tracer, None)
+    return stopped
+
+def is_tracing() -> bool:
+    return tracer != None
+
+@contextmanager
+def timed(name: str, **args):
+    """Observes the duration of the block in the histogram name
+
+    It can also be used as a decorator of a function. While tracing, the
+    block is recorded as span (without the _seconds suffix) with args.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        current = tracer
+        metrics.observe(name, end - start)
+
+        if current != None:
+            current.span(name.removesuffix("_seconds"), start, end, args)
+
+@contextmanager
+def span(name: str, **args):
+    """Records the block as span while tracing without observing a metric"""
+
+    if tracer == None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        current = tracer
+
+        # The tracer may have been stopped in the meantime.
+        if current != None:
+            current.span(name, start, time.perf_counter(), args)
+
+def timed_iter(name: str, iterable: Iterable[T]) -> Iterator[T]:
+    """Observes the time spent producing each item of a lazy iterable"""
+
+    iterator = iter(iterable)
+
+    while True:
+        start = time.perf_counter()
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+
+        end = time.perf_counter()
+        current = tracer
+        metrics.observe(name, end - start)
+
+        if current != None:
+            current.span(name.removesuffix("_seconds"), start, end)
+
+        yield item
+
+class Reporter:
+    """Periodically writes the metrics and refreshes a progress display
+
+    The display function is called with the current snapshot. Both are also
+    run a last time when the reporter is stopped, followed by finish, e.g.
+    to end the line of a progress bar.
+    """
+
+    def __init__(
+            self,
+            interval: float,
+            path: Optional[str] = None,
+            display: Optional[Callable[[dict], None]] = None,
+            finish: Optional[Callable[[], None]] = None):
+        self.interval = interval
+        self.path = path
+        self.display = display
+        self.finish = finish
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="orgxtract-reporter", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.stopped.set()
+        self.thread.join()
+
+        # A failed last report must not hide the error of the run.
+        try:
+            self.report()
+
+            if self.finish != None:
+                self.finish()
+        except Exception:
+            logger.exception("Metrics report failed")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            # A failed report, e.g. of a full disk, must not end the reporting.
+            try:
+                self.report()
+            except Exception:
+                logger.exception("Metrics report failed")
+
+    def report(self):
+        if self.path != None:
+            metrics.write(self.path)
+
+        if self.display != None:
+            self.display(metrics.snapshot())
@@ -1,4 +1,6 @@
-from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio
+from concurrent.futures import (as_completed, CancelledError, Executor, Future,
+                                InvalidStateError, ThreadPoolExecutor)
 from dataclasses import dataclass
 from enum import auto, IntFlag
 from importlib import resources
@@ -6,20 +8,32 @@ import itertools
 import json
 import logging
 import os
-from typing import Iterator, Optional
+from threading import Lock
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, Optional
 
+import numpy
 import spacy
 from spacy.language import Language
 from spacy.matcher import Matcher, PhraseMatcher
-from spacy.pipeline import EntityRuler
+from spacy.symbols import ADP, CCONJ, DET, NOUN, NUM, PROPN, X
 from spacy.tokens import Doc, Span, Token
+from spacy.util import filter_spans
 
 from .cleaning import line_break_resolver, token_normalizer
-from .semantic_analysis import SemanticAnalysis
+from .semantic_analysis import SemanticAnalysis, WORD_PUNCTUATION, merge_analyses
 from orgxtract import data
+from orgxtract.deadline import Deadline, DeadlineExceeded, Watchdog
+from orgxtract.telemetry import is_tracing, metrics, timed, timed_iter
 
 logger = logging.getLogger(__package__)
 
+# Status of results extracted by spaCy only, because the LLM analysis failed
+# or did not finish in time
+SPACY_ONLY = "spacy_only"
+# Status of results of texts whose LLM analysis failed for some of their
+# chunks, which only contain the analyses of the other chunks
+LLM_PARTIAL = "llm_partial"
+
 @dataclass(slots=True)
 class TextPipeline:
     """A pipeline to extract structured data from text
@@ -32,21 +46,41 @@ class TextPipeline:
     nlp: Language
     analyser: Optional[SemanticAnalysis]
     executor: Optional[Executor]
+    llm_timeout: Optional[float]
+    watchdog: Optional[Watchdog]
+    running: set[Future]
+    lock: Lock
 
     def __init__(
             self,
             data_path: Optional[str] = None,
             llm_model: Optional[str] = None,
             llm_key: Optional[str] = None,
-            n_threads: Optional[int] = None):
+            n_threads: Optional[int] = None,
+            llm_max_tokens: Optional[int] = 2048,
+            llm_timeout: Optional[float] = None):
         """Creates a new TextPipeline
 
         To use an LLM as named entity recognition (NER) system, only the name
         of the model and optionally the key if it is a remote LLM need to be
-        provided. For remote LLMs using multiple threads can lead to a
+        provided. Models of llm plugins run in-process, while a name like
+        "local:http://127.0.0.1:8080/v1" selects a local server providing an
+        OpenAI compatible completions API with batched prompts (e.g.
+        llama.cpp). For remote LLMs using multiple threads can lead to a
         significant speed boost because many requests can be sent at the
         same time.
 
+        Large texts are split along their paragraphs into chunks of at most
+        llm_max_tokens (estimated) tokens. The chunks are analysed
+        independently, which bounds the latency of a single request. Set it
+        to None to send every text as a whole.
+
+        An LLM request taking longer than llm_timeout seconds is abandoned
+        and the text falls back to the result of spaCy, which is marked with
+        "status": "spacy_only". If only some chunks of a text fail, the
+        analyses of the others are kept and the result is marked with
+        "status": "llm_partial".
+
         The data set used to find organigram entities can be configured by
         providing a path to a folder containing files for the:
           - schema (schema.json),
@@ -78,23 +112,32 @@ class TextPipeline:
         nlp.add_pipe("orgxtract_tagger", config={"data_path": data_path})
         nlp.add_pipe("orgxtract_ruler")
 
+        if is_tracing():
+            instrument_components(nlp)
+
         self.nlp = nlp
         self.analyser = None
         self.executor = None
+        self.llm_timeout = llm_timeout
+        self.watchdog = None
+        # Chunk futures of the requests being sent, abandoned on close
+        self.running = set()
+        self.lock = Lock()
 
         components = nlp.pipe_names
 
         if llm_model != None:
             try:
                 with open_resource(data_path, "schema.json") as file:
-                    schema = json.dumps(json.load(file),
-                                        ensure_ascii=False,
-                                        separators=(",", ":"))
+                    schema = json.load(file)
 
                     if n_threads != None and 0 < n_threads:
                         self.executor = ThreadPoolExecutor(max_workers=n_threads)
+                        # Abandons requests and texts whose deadline passed
+                        self.watchdog = Watchdog()
 
-                    self.analyser = SemanticAnalysis(llm_model, llm_key, schema)
+                    self.analyser = SemanticAnalysis(llm_model, llm_key, schema,
+                                                     llm_max_tokens, llm_timeout)
     
                 components = nlp.pipe_names + [llm_model]
             except Exception as error:
@@ -132,44 +175,268 @@ class TextPipeline:
         Fields can be None or non-existent. Properly check the key before!
         """
 
-        contents = self.nlp.pipe(texts, n_process=1)
+        contents = timed_iter("nlp_pipe_seconds", self.nlp.pipe(texts, n_process=1))
 
         if self.analyser != None:
             if self.executor != None:
-                futures = [(doc, self.executor.submit(self.analyser.analyse, doc.text))
-                           for doc in contents]
-
-                for (doc, future) in futures:
-                    ents = entities_to_dict(doc)
+                futures = [self.submit_doc(doc) for doc in contents]
 
-                    try:
-                        yield merge_dicts(ents, future.result())
-                    except Exception as error:
-                        logger.error("Analysis failed: %s(%s)}", type(error).__name__, error)
-                        yield ents
+                for future in futures:
+                    yield future.result()
             else:
                 for doc in contents:
-                    ents = entities_to_dict(doc)
-
-                    try:
-                        yield merge_dicts(ents, self.analyser.analyse(doc.text))
-                    except Exception as error:
-                        logger.error("Analysis failed: %s(%s)}", type(error).__name__, error)
-                        yield ents
+                    yield self.analyse_doc(doc)
         else:
             for doc in contents:
                 yield entities_to_dict(doc)
 
+    def pipe_as_completed(self, texts: Iterator[str]):
+        """Returns an iterator yielding (index, dictionary) as they complete
+
+        Unlike pipe, the result of a text is yielded as soon as its analysis
+        is done, so a slow LLM request does not hold back the results of the
+        other texts. The index is the position of the text in texts. Without
+        a thread pool the results are yielded in order.
+        """
+
+        if self.analyser == None or self.executor == None:
+            yield from enumerate(self.pipe(texts))
+            return
+
+        contents = timed_iter("nlp_pipe_seconds", self.nlp.pipe(texts, n_process=1))
+        futures = {self.submit_doc(doc):index for (index, doc) in enumerate(contents)}
+
+        for future in as_completed(futures):
+            yield (futures[future], future.result())
+
+    async def apipe(
+            self,
+            texts: Iterable[str] | AsyncIterable[str],
+            max_pending: int = 32,
+            batch_size: int = 16) -> AsyncIterator[tuple[int, dict]]:
+        """Returns an async iterator yielding (index, dictionary) as they complete
+
+        Like pipe_as_completed, but the event loop is never blocked. spaCy
+        runs in the thread pool of the event loop on batches of batch_size
+        texts and the LLM analyses in the thread pool of the pipeline. At
+        most max_pending texts are in flight: no more texts are taken from
+        texts until a result is consumed, which passes backpressure on to
+        the producer.
+
+        Leaving the iteration early or cancelling the consuming task cancels
+        the analyses in flight, including the requests already sent to the
+        LLM. Without a thread pool, the analysis of a text runs in the thread
+        pool of the event loop and only texts not yet started are cancelled.
+        """
+
+        loop = asyncio.get_running_loop()
+        # Index of the text by pending future
+        pending: dict[asyncio.Future, int] = {}
+        index = 0
+
+        def process(batch: list[str]) -> list[Doc]:
+            return list(timed_iter("nlp_pipe_seconds", self.nlp.pipe(batch, n_process=1)))
+
+        try:
+            async for batch in batches(texts, batch_size):
+                for doc in await loop.run_in_executor(None, process, batch):
+                    while max_pending <= len(pending):
+                        (done, _) = await asyncio.wait(pending,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+
+                        for future in done:
+                            yield (pending.pop(future), future.result())
+
+                    if self.analyser == None:
+                        future = loop.create_future()
+                        future.set_result(entities_to_dict(doc))
+                    elif self.executor != None:
+                        future = asyncio.wrap_future(self.submit_doc(doc))
+                    else:
+                        future = loop.run_in_executor(None, self.analyse_doc, doc)
+
+                    pending[future] = index
+                    index += 1
+
+            while 0 < len(pending):
+                (done, _) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for future in done:
+                    yield (pending.pop(future), future.result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def submit(
+            self,
+            texts: Iterator[str],
+            deadlines: Optional[Iterable[Optional[Deadline]]] = None) -> list[Future]:
+        """Returns a future for the extracted data of each text
+
+        Only spaCy runs in the calling thread. The LLM analyses are left to
+        the thread pool, which allows the caller to continue with the next
+        texts while the requests are in flight. Without a thread pool the
+        futures are already done when returned.
+
+        The future of a text with a deadline is done by then at the latest.
+        If the LLM analysis is not, its pending requests are cancelled and
+        the future gets the result of spaCy. Without a thread pool a request
+        is only left between chunks or streamed parts of the response.
+        """
+
+        if self.analyser == None:
+            futures = []
+
+            for content in self.pipe(texts):
+                future = Future()
+                future.set_result(content)
+                futures.append(future)
+
+            return futures
+
+        contents = timed_iter("nlp_pipe_seconds", self.nlp.pipe(texts, n_process=1))
+
+        if deadlines == None:
+            deadlines = itertools.repeat(None)
+
+        if self.executor == None:
+            futures = []
+
+            for (doc, deadline) in zip(contents, deadlines):
+                future = Future()
+                future.set_result(self.analyse_doc(doc, deadline))
+                futures.append(future)
+
+            return futures
+
+        return [self.submit_doc(doc, deadline) for (doc, deadline) in zip(contents, deadlines)]
+
+    def submit_doc(self, doc: Doc, deadline: Optional[Deadline] = None) -> Future:
+        result = Future()
+        chunks = self.analyser.split(doc.text)
+        # The workers complete these futures unless the watchdog abandons
+        # them first.
+        futures = [Future() for _ in chunks]
+        tasks = [self.executor.submit(self.analyse, chunk, future)
+                 for (chunk, future) in zip(chunks, futures)]
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def on_done(_future: Future):
+            with lock:
+                remaining[0] -= 1
+                is_last = remaining[0] == 0
+
+            if is_last and not result.done():
+                set_result(result, merge_futures(doc, futures))
+
+        def on_expired():
+            ents = entities_to_dict(doc)
+            ents["status"] = SPACY_ONLY
+
+            if set_result(result, ents):
+                logger.warning("Analysis cancelled by deadline")
+                metrics.count("analysis_timeouts_total")
+                abandon(tasks, futures)
+
+        def on_result(result: Future):
+            # A caller cancelling the result, e.g. apipe, is not interested
+            # in the requests anymore.
+            if result.cancelled():
+                abandon(tasks, futures)
+
+        if deadline != None:
+            handle = self.watchdog.schedule(deadline, on_expired)
+            result.add_done_callback(lambda _result: self.watchdog.cancel(handle))
+
+        result.add_done_callback(on_result)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+        return result
+
+    def analyse(self, chunk: str, future: Future):
+        # Cancelled futures belong to texts whose deadline passed.
+        if not future.set_running_or_notify_cancel():
+            return
+
+        with self.lock:
+            self.running.add(future)
+
+        deadline = Deadline.after(self.llm_timeout)
+        handle = None
+
+        if deadline != None:
+            expired = DeadlineExceeded("LLM request deadline exceeded")
+            handle = self.watchdog.schedule(deadline,
+                                            lambda: set_exception(future, expired))
+
+        try:
+            # The request is left as soon as the future is abandoned.
+            set_result(future, self.analyser.analyse(chunk, deadline, future.done))
+        except Exception as error:
+            set_exception(future, error)
+        finally:
+            with self.lock:
+                self.running.discard(future)
+
+            if handle != None:
+                self.watchdog.cancel(handle)
+
+    def analyse_doc(self, doc: Doc, deadline: Optional[Deadline] = None) -> dict:
+        """Returns the extracted data of doc analysed in the calling thread
+
+        Once the deadline passed, the remaining chunks are not sent and a
+        streamed response is left. Only the chunks analysed by then are
+        merged, see merge_chunks.
+        """
+
+        chunks = self.analyser.split(doc.text)
+        analyses = []
+
+        for chunk in chunks:
+            if deadline != None and deadline.is_expired():
+                logger.warning("Analysis cancelled by deadline")
+                metrics.count("analysis_timeouts_total")
+                break
+
+            try:
+                analyses.append(self.analyser.analyse(
+                    chunk, earliest(deadline, Deadline.after(self.llm_timeout))))
+            except Exception as error:
+                if deadline != None and deadline.is_expired():
+                    logger.warning("Analysis cancelled by deadline")
+                    metrics.count("analysis_timeouts_total")
+                    break
+
+                report_failure(error)
+
+        return merge_chunks(doc, analyses, len(chunks))
+
     def close(self):
         """Frees any allocated resources
 
-        This frees the resources used for the thread pool. It is, however,
-        better to use Python's with statement instead of calling this
-        function manually.            
+        This frees the resources used for the thread pool. Requests still
+        being sent are abandoned, so a hung request does not block closing.
+        It is, however, better to use Python's with statement instead of
+        calling this function manually.
         """
 
         if self.executor != None:
-            self.executor.shutdown(cancel_futures=True)
+            with self.lock:
+                running = list(self.running)
+
+            for future in running:
+                set_exception(future, CancelledError("Text pipeline closed"))
+
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.watchdog != None:
+            self.watchdog.close()
+
+        if self.analyser != None:
+            self.analyser.close()
 
 class OrgX(IntFlag):
     NONE = 0
@@ -181,12 +448,19 @@ class OrgX(IntFlag):
     ORG = ORG_TYPE
     PER = PER_POSITION | PER_SALUTATION | PER_TITLE | PER_NN
 
-Token.set_extension("orgx", default=OrgX.NONE)
+# The OrgX tags of the tokens of a doc, one OrgX value per token. Matching
+# and entity building read the array instead of per-token extensions.
+Doc.set_extension("orgx_tags", default=None)
+Token.set_extension("orgx", getter=lambda token: orgx_tag(token.doc, token.i))
 Token.set_extension("is_orgx_org",
                     getter=lambda token: token._.orgx & OrgX.ORG != OrgX.NONE)
 Token.set_extension("is_orgx_per",
                     getter=lambda token: token._.orgx & OrgX.PER != OrgX.NONE)
 
+def orgx_tag(doc: Doc, i: int) -> OrgX:
+    tags = doc._.orgx_tags
+    return OrgX(int(tags[i])) if tags is not None else OrgX.NONE
+
 @Language.factory("orgxtract_tagger")
 def orgxtract_tagger(nlp: Language, name: str, data_path: Optional[str]):
     term_matcher = PhraseMatcher(nlp.vocab, validate=True)
@@ -210,81 +484,146 @@ def orgxtract_tagger(nlp: Language, name: str, data_path: Optional[str]):
 
     term_matcher.add("PER_NN", [nlp.make_doc("N.N."), nlp.make_doc("N. N.")])
 
-    ORG_TYPE = nlp.vocab["ORG_TYPE"]
-    PER_POSITION = nlp.vocab["PER_POSITION"]
-    PER_SALUTATION = nlp.vocab["PER_SALUTATION"]
-    PER_TITLE = nlp.vocab["PER_TITLE"]
-    PER_NN = nlp.vocab["PER_NN"]
-
-    filler = Matcher(nlp.vocab, validate=True)
-    filler.add("SPACE", [
-        [{"_": {"is_orgx_org": True}}, {"TAG": "_SP", "OP": "+"}, {"_": {"is_orgx_org": True}}],
-        [{"_": {"is_orgx_per": True}}, {"TAG": "_SP", "OP": "+"}, {"_": {"is_orgx_per": True}}],
-    ])
+    TAGS = {
+        nlp.vocab.strings["ORG_TYPE"]: OrgX.ORG_TYPE,
+        nlp.vocab.strings["PER_POSITION"]: OrgX.PER_POSITION,
+        nlp.vocab.strings["PER_SALUTATION"]: OrgX.PER_SALUTATION,
+        nlp.vocab.strings["PER_TITLE"]: OrgX.PER_TITLE,
+        nlp.vocab.strings["PER_NN"]: OrgX.PER_NN,
+    }
+    SP = nlp.vocab.strings.add("_SP")
 
     def tag(doc: Doc):
+        tags = numpy.zeros(len(doc), dtype=numpy.uint8)
+
         for (match_id, start, end) in term_matcher(doc):
-            tag = OrgX.NONE
+            tags[start:end] = TAGS.get(match_id, OrgX.NONE).value
 
-            if match_id == ORG_TYPE:
-                tag = OrgX.ORG_TYPE
-            elif match_id == PER_POSITION:
-                tag = OrgX.PER_POSITION
-            elif match_id == PER_SALUTATION:
-                tag = OrgX.PER_SALUTATION
-            elif match_id == PER_TITLE:
-                tag = OrgX.PER_TITLE
-            elif match_id == PER_NN:
-                tag = OrgX.PER_NN
+        # Runs of whitespace between two tokens of the same kind (ORG or
+        # PER) take the tag of the token before them.
+        is_space = doc.to_array("TAG") == SP
 
-            for token in doc[start:end]:
-                token._.orgx = tag
+        for (start, end) in runs(is_space):
+            if 0 < start and end < len(doc):
+                (before, after) = (tags[start - 1], tags[end])
 
-        for (_match_id, start, end) in filler(doc):
-            tag = doc[start]._.orgx
+                if (before & after & OrgX.ORG.value) or (before & OrgX.PER.value and after & OrgX.PER.value):
+                    tags[start:end] = before
 
-            for token in doc[start + 1:end - 1]:
-                token._.orgx = tag
+        doc._.orgx_tags = tags
 
         return doc
 
     return tag
 
-Span.set_extension("orgx", default=())
+Span.set_extension("orgx", getter=lambda span: tuple(components(span)))
 
 @Language.factory("orgxtract_ruler")
 def orgxtract_ruler(nlp: Language, name: str):
-    entity_ruler = EntityRuler(nlp, name, overwrite_ents=False, validate=True)
-    entity_ruler.add_patterns([
-        {"label": "ORG", "pattern": [
-            {"_": {"orgx": OrgX.ORG_TYPE}}, {"TAG": "_SP", "OP": "?"}, {"_": {"is_orgx_per": False}, "POS": {"IN": ["NOUN", "PROPN", "NUM", "X", "ADP", "CCONJ", "DET"]}, "OP": "+"}
-        ]},
-        {"label": "PER", "pattern": [{"_": {"orgx": OrgX.PER_NN}, "OP": "+"}]},
-        {"label": "PER", "pattern": [
-            {"_": {"is_orgx_per": True}, "OP": "+"}, {"TAG": "_SP", "OP": "?"}, {"POS": {"IN": ["NOUN", "PROPN"]}, "OP": "+"}
-        ]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd.dd.dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd.dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dddd"}]},
-        {"label": "DATE", "pattern": [{"SHAPE": "dd."}, {"POS": "NOUN"}, {"SHAPE": "dddd"}]},
+    date_matcher = Matcher(nlp.vocab, validate=True)
+    date_matcher.add("DATE", [
+        [{"SHAPE": "dd.dd.dddd"}],
+        [{"SHAPE": "dd.dddd"}],
+        [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dddd"}],
+        [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "-", "SPACY": False}, {"SHAPE": "dddd"}],
+        [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dddd"}],
+        [{"SHAPE": "dd", "SPACY": False}, {"TEXT": "/", "SPACY": False}, {"SHAPE": "dddd"}],
+        [{"SHAPE": "dd."}, {"POS": "NOUN"}, {"SHAPE": "dddd"}],
     ])
 
-    PER = nlp.vocab["PER"]
-    ORG = nlp.vocab["ORG"]
+    SP = nlp.vocab.strings.add("_SP")
+    ORG_POS = [NOUN, PROPN, NUM, X, ADP, CCONJ, DET]
+    PER_POS = [NOUN, PROPN]
 
     def rule(doc: Doc):
-        doc = entity_ruler(doc)
-
-        for entity in doc.ents:
-            entity._.orgx = tuple(components(entity))
+        tags = doc._.orgx_tags
+
+        if tags is None:
+            tags = numpy.zeros(len(doc), dtype=numpy.uint8)
+
+        attributes = doc.to_array(["TAG", "POS", "ENT_TYPE"])
+        is_space = attributes[:, 0] == SP
+        is_per = tags & OrgX.PER.value != 0
+        is_per_nn = tags == OrgX.PER_NN.value
+        is_org_word = numpy.isin(attributes[:, 1], ORG_POS) & ~is_per
+        is_per_word = numpy.isin(attributes[:, 1], PER_POS)
+        per_ends = run_ends(is_per)
+
+        # Every match of the patterns, like a Matcher does
+        #   - ORG: ORG_TYPE, an optional space and words not belonging to a
+        #     person,
+        #   - PER: N.N. and
+        #   - PER: person tags, an optional space and nouns.
+        spans = match_spans(doc, "ORG", numpy.flatnonzero(tags == OrgX.ORG_TYPE.value),
+                            lambda start: (start + 1,), is_space, is_org_word)
+        spans += [Span(doc, start, end, label="PER")
+                  for (run_start, run_end) in runs(is_per_nn)
+                  for start in range(run_start, run_end)
+                  for end in range(start + 1, run_end + 1)]
+        spans += match_spans(doc, "PER", numpy.flatnonzero(is_per),
+                             lambda start: range(start + 1, per_ends[start] + 1),
+                             is_space, is_per_word)
+        spans += [Span(doc, start, end, label=match_id)
+                  for (match_id, start, end) in date_matcher(doc)]
+
+        # Like an EntityRuler not overwriting entities: the longest spans
+        # win and spans overlapping existing entities are dropped.
+        is_entity = attributes[:, 2] != 0
+        spans = [span for span in spans if not is_entity[span.start:span.end].any()]
+        doc.ents = list(doc.ents) + filter_spans(spans)
 
         return doc
 
     return rule
 
+def runs(mask: numpy.ndarray) -> list[tuple[int, int]]:
+    """Returns the (start, end) of the runs of True in mask"""
+
+    padded = numpy.concatenate(([False], mask, [False]))
+    changes = numpy.flatnonzero(padded[1:] != padded[:-1]).tolist()
+
+    return list(zip(changes[::2], changes[1::2]))
+
+def run_ends(mask: numpy.ndarray) -> list[int]:
+    """Returns the end of the run of True each index belongs to"""
+
+    ends = list(range(len(mask)))
+
+    for (start, end) in runs(mask):
+        ends[start:end] = [end] * (end - start)
+
+    return ends
+
+def match_spans(
+        doc: Doc,
+        label: str,
+        starts: numpy.ndarray,
+        head_ends: Callable[[int], Iterable[int]],
+        is_space: numpy.ndarray,
+        is_word: numpy.ndarray) -> list[Span]:
+    """Returns all spans of a head, an optional space and one or more words
+
+    head_ends returns the possible ends of the head beginning at a start.
+    """
+
+    word_ends = run_ends(is_word)
+    spans = []
+
+    for start in starts.tolist():
+        for head_end in head_ends(start):
+            # The words follow the head directly or after a space.
+            word_starts = [head_end]
+
+            if head_end < len(doc) and is_space[head_end]:
+                word_starts.append(head_end + 1)
+
+            for i in word_starts:
+                if i < len(doc) and is_word[i]:
+                    spans += [Span(doc, start, end, label=label)
+                              for end in range(i + 1, word_ends[i] + 1)]
+
+    return spans
+
 def entities_to_dict(doc: Doc):
     if len(doc.ents) == 0:
         return {}
@@ -335,6 +674,178 @@ def entities_to_dict(doc: Doc):
 
     return content
 
+class TimedComponent:
+    """Wraps a spaCy component to observe the time spent in it
+
+    Batches are taken from the previous components before the clock starts,
+    so the time is exclusive to the component. The histogram is named
+    spacy_<name>_seconds.
+    """
+
+    def __init__(self, name: str, component):
+        self.name = name
+        self.metric = f"spacy_{name}_seconds"
+        self.component = component
+
+    def __call__(self, doc: Doc, **kwargs) -> Doc:
+        with timed(self.metric, docs=1):
+            return self.component(doc, **kwargs)
+
+    def pipe(self, docs: Iterator[Doc], batch_size: int = 128, **kwargs) -> Iterator[Doc]:
+        pipe = getattr(self.component, "pipe", None)
+
+        for batch in spacy.util.minibatch(docs, size=batch_size):
+            with timed(self.metric, docs=len(batch)):
+                if pipe != None:
+                    batch = list(pipe(batch, batch_size=batch_size, **kwargs))
+                else:
+                    batch = [self.component(doc, **kwargs) for doc in batch]
+
+            yield from batch
+
+    def __getattr__(self, name: str):
+        return getattr(self.component, name)
+
+# Components handed to the orgxtract_component factory by replace_component
+PENDING_COMPONENTS: dict[str, Callable] = {}
+
+@Language.factory("orgxtract_component", default_config={"key": ""})
+def orgxtract_component(nlp: Language, name: str, key: str):
+    return PENDING_COMPONENTS[key]
+
+def replace_component(nlp: Language, name: str, component: Callable):
+    """Replaces the component called name by an instance
+
+    Language.replace_pipe only takes factories, so the instance is handed to
+    the orgxtract_component factory.
+    """
+
+    key = f"{name}:{id(component)}"
+    PENDING_COMPONENTS[key] = component
+
+    try:
+        nlp.replace_pipe(name, "orgxtract_component", config={"key": key})
+    finally:
+        del PENDING_COMPONENTS[key]
+
+def instrument_components(nlp: Language):
+    """Wraps every component of the pipeline in a TimedComponent"""
+
+    for (name, component) in list(nlp.pipeline):
+        if not isinstance(component, TimedComponent):
+            replace_component(nlp, name, TimedComponent(name, component))
+
+def uninstrument_components(nlp: Language):
+    """Restores the components wrapped by instrument_components"""
+
+    for (name, component) in list(nlp.pipeline):
+        if isinstance(component, TimedComponent):
+            replace_component(nlp, name, component.component)
+
+async def batches(texts: Iterable[str] | AsyncIterable[str], size: int) -> AsyncIterator[list[str]]:
+    batch = []
+
+    if isinstance(texts, AsyncIterable):
+        async for text in texts:
+            batch.append(text)
+
+            if size <= len(batch):
+                yield batch
+                batch = []
+    else:
+        for text in texts:
+            batch.append(text)
+
+            if size <= len(batch):
+                yield batch
+                batch = []
+
+    if 0 < len(batch):
+        yield batch
+
+def abandon(tasks: list[Future], futures: list[Future]):
+    """Cancels the analyses of the chunks of a text
+
+    Requests already running cannot be cancelled. Their futures get a
+    CancelledError, which stops the request at its next streamed chunk.
+    """
+
+    for task in tasks:
+        task.cancel()
+
+    for future in futures:
+        if not future.cancel():
+            set_exception(future, CancelledError("Analysis cancelled"))
+
+def merge_futures(doc: Doc, futures: list[Future]):
+    analyses = []
+
+    for future in futures:
+        try:
+            analyses.append(future.result())
+        except Exception as error:
+            report_failure(error)
+
+    return merge_chunks(doc, analyses, len(futures))
+
+def merge_chunks(doc: Doc, analyses: list[dict], count: int) -> dict:
+    """Returns the entities of spaCy merged with the analyses of the chunks
+
+    The analyses are those of the chunks that succeeded out of count. If
+    some are missing the result is marked LLM_PARTIAL, if all are missing
+    it is the result of spaCy marked SPACY_ONLY.
+    """
+
+    if 0 < len(analyses):
+        try:
+            result = merge_dicts(entities_to_dict(doc), merge_analyses(analyses))
+
+            if len(analyses) < count:
+                result["status"] = LLM_PARTIAL
+
+            return result
+        except Exception as error:
+            report_failure(error)
+
+    ents = entities_to_dict(doc)
+    ents["status"] = SPACY_ONLY
+    return ents
+
+def earliest(a: Optional[Deadline], b: Optional[Deadline]) -> Optional[Deadline]:
+    """Returns the deadline expiring first, None stands for no deadline"""
+
+    if a == None:
+        return b
+
+    if b == None:
+        return a
+
+    return min(a, b)
+
+def report_failure(error: Exception):
+    if isinstance(error, (DeadlineExceeded, CancelledError)):
+        logger.warning("Analysis abandoned: %s", error)
+        metrics.count("llm_timeouts_total")
+    else:
+        logger.error("Analysis failed: %s(%s)}", type(error).__name__, error)
+        metrics.count("llm_failures_total")
+
+def set_result(future: Future, result) -> bool:
+    """Sets the result unless the future is already done"""
+
+    try:
+        future.set_result(result)
+        return True
+    except InvalidStateError:
+        return False
+
+def set_exception(future: Future, exception: BaseException) -> bool:
+    try:
+        future.set_exception(exception)
+        return True
+    except InvalidStateError:
+        return False
+
 def merge_dicts(spacy_extracted, llm_extracted):
     # Clean llm output
     confabulated = set(llm_extracted.get("error", {}).get("confabulated", []))
@@ -443,25 +954,30 @@ def merge_dicts(spacy_extracted, llm_extracted):
 
     return spacy_extracted
 
-def remove_confabulated_parts(name: str, confabulated):
-    new_name = ""
+def remove_confabulated_parts(name: str, confabulated: set[str]):
+    parts = [part for part in name.split()
+             if part.strip(WORD_PUNCTUATION) not in confabulated]
+
+    return " ".join(parts)
+
+def components(span: Span):
+    """Yields the (orgx, start, end) of the runs of equal OrgX tags in span"""
 
-    for part in name.split():
-        if part not in confabulated:
-            new_name += part + " "
+    tags = span.doc._.orgx_tags
 
-    return new_name.rstrip()
+    if tags is None:
+        yield (OrgX.NONE, 0, len(span))
+        return
 
-def components(entity: Span):
+    tags = tags[span.start:span.end]
     start = 0
 
-    for end in range(1, len(entity)):
-        if entity[end - 1]._.orgx != entity[end]._.orgx:
-            yield (entity[end - 1]._.orgx, start, end)
-            start = end
+    for end in (numpy.flatnonzero(tags[1:] != tags[:-1]) + 1).tolist():
+        yield (OrgX(int(tags[start])), start, end)
+        start = end
 
-    if start < len(entity):
-        yield (entity[start]._.orgx, start, len(entity))
+    if start < len(tags):
+        yield (OrgX(int(tags[start])), start, len(tags))
 
 def clean_text(span: Span):
     SP = span.doc.vocab["_SP"]
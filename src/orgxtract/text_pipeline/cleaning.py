@@ -3,6 +3,8 @@ from spacy.lang.char_classes import LATIN_LOWER_BASIC, LATIN_UPPER_BASIC
 from spacy.matcher import Matcher
 from spacy.tokens import Doc
 
+from orgxtract.telemetry import metrics
+
 @Language.factory("token_normalizer")
 def token_normalizer(nlp: Language, name: str):
     matcher = Matcher(nlp.vocab, validate=True)
@@ -55,6 +57,8 @@ def token_normalizer(nlp: Language, name: str):
         for token in doc[last_end:]:
             add_token(token.text, 0 < len(token.whitespace_))
 
+        # The changed tokens run through the whole pipeline again.
+        metrics.count("token_normalizer_reruns_total")
         return nlp(Doc(nlp.vocab, words, spaces))
 
     return normalize
@@ -175,6 +179,7 @@ def line_break_resolver(nlp: Language, name: str):
         for token in doc[last_end:]:
             add_token(token.text, 0 < len(token.whitespace_))
 
+        metrics.count("line_break_resolver_reruns_total")
         return nlp(Doc(nlp.vocab, words, spaces))
 
     return resolve
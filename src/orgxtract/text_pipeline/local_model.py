@@ -0,0 +1,304 @@
+from concurrent.futures import CancelledError, Future, InvalidStateError
+import http.client
+import json
+import logging
+from queue import Empty, SimpleQueue
+import socket
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+import llm
+
+logger = logging.getLogger(__package__)
+
+# Model names with this prefix select a LocalModel, e.g.
+# local:http://127.0.0.1:8080/v1?model=qwen2.5-3b-instruct
+LOCAL_PREFIX = "local:"
+
+# Seconds close waits for the batching thread after abandoning its request
+CLOSE_TIMEOUT = 5.0
+
+CONNECTIONS = {
+    "http": http.client.HTTPConnection,
+    "https": http.client.HTTPSConnection,
+}
+
+class LocalModel:
+    """A model served by a local OpenAI compatible completions server
+
+    Servers like llama.cpp run small quantised models on the same machine,
+    so no network access is needed. Concurrent prompts are collected into
+    batches, which are sent as a single request over a persistent
+    connection. llama.cpp is asked to keep the evaluated prompt
+    (cache_prompt), so the static prompt prefix is only evaluated once.
+
+    Only the subset of llm.Model used by SemanticAnalysis is implemented.
+    Closing the model fails all prompts not answered yet.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            batch_size: int = 8,
+            batch_wait: float = 0.01,
+            max_tokens: int = 2048,
+            timeout: Optional[float] = None):
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+
+        if parts.scheme not in CONNECTIONS:
+            raise ValueError(f"unsupported URL scheme of local model: {parts.scheme!r}")
+
+        self.connection_class = CONNECTIONS[parts.scheme]
+        self.key: Optional[str] = None
+        self.model_id = query.get("model", [None])[0]
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port
+        self.path = (parts.path.rstrip("/") or "/v1") + "/completions"
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.queue: SimpleQueue[Optional[LocalResponse]] = SimpleQueue()
+        self.connection: Optional[http.client.HTTPConnection] = None
+        # The batch being sent, failed by close
+        self.batch: list[LocalResponse] = []
+        self.lock = Lock()
+        self.is_closed = False
+        self.thread = Thread(target=self.run, name="orgxtract-local-model", daemon=True)
+        self.thread.start()
+
+    def prompt(self, prompt: str, **options) -> "LocalResponse":
+        response = LocalResponse(prompt, options)
+
+        with self.lock:
+            if self.is_closed:
+                resolve(response.future, exception=CancelledError("Local model closed"))
+            else:
+                self.queue.put(response)
+
+        return response
+
+    def close(self):
+        """Fails the pending prompts and stops the batching thread
+
+        A request in flight is abandoned by shutting down its socket. The
+        thread is only waited for CLOSE_TIMEOUT seconds, it is a daemon.
+        """
+
+        with self.lock:
+            if self.is_closed:
+                return
+
+            self.is_closed = True
+            batch = self.batch
+            connection = self.connection
+
+        closed = CancelledError("Local model closed")
+
+        for response in batch:
+            resolve(response.future, exception=closed)
+
+        while True:
+            try:
+                response = self.queue.get_nowait()
+            except Empty:
+                break
+
+            if response != None:
+                resolve(response.future, exception=closed)
+
+        # Stops the thread once it is done with the batch
+        self.queue.put(None)
+
+        if connection != None and connection.sock != None:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        self.thread.join(CLOSE_TIMEOUT)
+
+        if self.thread.is_alive():
+            logger.warning("Local model thread still running after close")
+
+    def run(self):
+        while True:
+            response = self.queue.get()
+
+            if response == None:
+                break
+
+            batch = [response]
+            is_stopping = False
+
+            # Prompts arriving within the wait time or while the previous
+            # batch was in flight are sent together.
+            while len(batch) < self.batch_size:
+                try:
+                    response = self.queue.get(timeout=self.batch_wait)
+                except Empty:
+                    break
+
+                if response == None:
+                    is_stopping = True
+                    break
+
+                batch.append(response)
+
+            with self.lock:
+                if self.is_closed:
+                    # close fails the prompts it took from the queue, these
+                    # were taken before.
+                    for response in batch:
+                        resolve(response.future, exception=CancelledError("Local model closed"))
+
+                    break
+
+                self.batch = batch
+
+            # Prompts waiting for a batch that failed unexpectedly would hang
+            # forever, so the thread keeps running.
+            try:
+                self.send(batch)
+            except Exception as error:
+                logger.exception("Local model batch failed")
+
+                for response in batch:
+                    resolve(response.future, exception=error)
+            finally:
+                with self.lock:
+                    self.batch = []
+
+            if is_stopping:
+                break
+
+        if self.connection != None:
+            self.connection.close()
+
+    def send(self, batch: list["LocalResponse"]):
+        # Prompts are only batched with prompts using the same options.
+        groups: dict[str, list[LocalResponse]] = {}
+
+        for response in batch:
+            key = json.dumps(response.options, sort_keys=True)
+            groups.setdefault(key, []).append(response)
+
+        for group in groups.values():
+            body = {
+                "prompt": [response.prompt for response in group],
+                "max_tokens": self.max_tokens,
+                "cache_prompt": True,
+                **group[0].options,
+            }
+
+            if self.model_id != None:
+                body["model"] = self.model_id
+
+            # All choices are parsed before any prompt is resolved, so an
+            # error fails the whole group.
+            try:
+                result = self.request(body)
+                texts = [""] * len(group)
+
+                for choice in result["choices"]:
+                    texts[choice["index"]] = choice["text"]
+            except Exception as error:
+                # Requests abandoned by close are expected to fail.
+                if not self.is_closed:
+                    logger.error("Local model request failed: %s(%s)",
+                                 type(error).__name__, error)
+
+                for response in group:
+                    resolve(response.future, exception=error)
+
+                continue
+
+            for (response, text) in zip(group, texts):
+                resolve(response.future, text)
+
+    def request(self, body: dict) -> dict:
+        headers = {"Content-Type": "application/json"}
+
+        if self.key != None:
+            headers["Authorization"] = f"Bearer {self.key}"
+
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+        # A kept-alive connection may have been closed by the server in the
+        # meantime, which is why a request is retried once.
+        for attempt in range(2):
+            if self.connection == None:
+                connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+
+                # close shuts down the socket of the connection it sees.
+                with self.lock:
+                    if self.is_closed:
+                        raise CancelledError("Local model closed")
+
+                    self.connection = connection
+
+            try:
+                self.connection.request("POST", self.path, data, headers)
+                response = self.connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError) as error:
+                self.connection.close()
+                self.connection = None
+
+                if 0 < attempt or isinstance(error, TimeoutError):
+                    raise
+
+                continue
+
+            if response.status != 200:
+                raise http.client.HTTPException(
+                    f"{response.status} {response.reason}: {content[:200]!r}")
+
+            return json.loads(content)
+
+class LocalResponse:
+    """The pending response of a LocalModel to a prompt
+
+    Batched completions are not streamed, so iterating the response yields
+    the whole text as a single chunk once the batch is done.
+    """
+
+    __slots__ = ("prompt", "options", "future")
+
+    def __init__(self, prompt: str, options: dict):
+        self.prompt = prompt
+        self.options = options
+        self.future: Future[str] = Future()
+
+    def __iter__(self):
+        yield self.text()
+
+    def text(self) -> str:
+        return self.future.result()
+
+def resolve(future: Future, result: Optional[str] = None, exception: Optional[Exception] = None):
+    # A future may already be done if the batching thread failed before, which
+    # must not stop the thread.
+    try:
+        if exception != None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+def get_model(model_name: str, timeout: Optional[float] = None):
+    """Returns the model for the model name
+
+    Names prefixed with "local:" select a LocalModel for the URL after the
+    prefix, whose requests time out after timeout seconds. Any other name is
+    looked up with llm, which includes models of plugins running in-process
+    like llm-gpt4all or llm-llama-cpp.
+    """
+
+    if model_name.startswith(LOCAL_PREFIX):
+        return LocalModel(model_name.removeprefix(LOCAL_PREFIX), timeout=timeout)
+
+    return llm.get_model(model_name)
@@ -0,0 +1,54 @@
+import json
+
+INSTRUCTIONS = (
+    r"""You are a model that parses unstructured content from organizational charts into a provided json schema. Only provide the resulting json without any other text or comments. You should not add any additional data under any circumstance. If you can't find some information, leave the field to null. The "name" field after type usually consists of the previously found "type" and an additional identifier like numbers or letters. The contact field only consists of numbers. """
+    r"""Here is an example of a parsed entity: {"type":"Abteilung","name":"Abteilung V","persons":[{"name":"Schröder","positionType":"MD"}],"responsibilities":["Föderale Finanzbeziehungen","Staats- und Verfassungsrecht","Rechtsangelegenheiten","Historiker-Kommission"]} . """
+)
+
+def build_prefix(schema: dict) -> str:
+    """Returns the static part of the prompt
+
+    The prefix is the same for every text. Providers and local servers
+    caching prompt prefixes can reuse it as long as it stays byte-identical,
+    which is why the variable content must only ever be appended.
+    """
+
+    return (
+        INSTRUCTIONS
+        + f"The json schema looks like this: {compact_schema(schema)} . "
+        + "And this is the provided content: "
+    )
+
+def compact_schema(schema: dict) -> str:
+    """Renders a JSON schema in a compact TypeScript like notation
+
+    Only the structure, the value types and the enums are kept. Keywords
+    which are irrelevant for the LLM like $schema and required are dropped.
+
+    {"type":"object","properties":{"name":{"type":"string"}}} is rendered
+    as {name:string} and an enum as "a"|"b".
+    """
+
+    enum = schema.get("enum")
+    if enum != None:
+        return "|".join(json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+                        for value in enum)
+
+    properties = schema.get("properties")
+    if properties != None:
+        fields = ",".join(f"{key}:{compact_schema(value)}"
+                          for (key, value) in properties.items())
+        return "{" + fields + "}"
+
+    items = schema.get("items")
+    if items != None:
+        if isinstance(items, list):
+            items = items[0] if 0 < len(items) else {}
+
+        return "[" + compact_schema(items) + "]"
+
+    schema_type = schema.get("type", "any")
+    if isinstance(schema_type, list):
+        return "|".join(schema_type)
+
+    return schema_type
@@ -1,60 +1,147 @@
+from concurrent.futures import CancelledError
 from dataclasses import dataclass
 import json
-from typing import Optional
+import logging
+from threading import Lock
+from typing import Any, Callable, Optional
 
-import llm
 from llm import Model
 from fix_busted_json import repair_json
 
+from .local_model import get_model
+from .prompt import build_prefix
+from orgxtract.deadline import Deadline
+from orgxtract.telemetry import metrics, timed
+
+logger = logging.getLogger(__package__)
+
 @dataclass(slots=True)
 class SemanticAnalysis:
     model: Model
-    schema: str
+    prefix: str
+    validate: Callable[[Any], Any]
+    max_tokens: Optional[int]
+    usage: "TokenUsage"
 
-    def __init__(self, model_name: str, api_key: Optional[str], schema: str):
-        model = llm.get_model(model_name)
+    def __init__(
+            self,
+            model_name: str,
+            api_key: Optional[str],
+            schema: dict,
+            max_tokens: Optional[int] = None,
+            timeout: Optional[float] = None):
+        model = get_model(model_name, timeout)
         model.key = api_key
         self.model = model
-        self.schema = schema
+        self.prefix = build_prefix(schema)
+        self.validate = compile_schema(schema)
+        self.max_tokens = max_tokens
+        self.usage = TokenUsage()
+
+    def split(self, text: str) -> list[str]:
+        """Returns the chunks of text which are analysed separately
+
+        Without a token budget the text is returned as a single chunk.
+        """
+
+        if self.max_tokens == None:
+            return [text]
+
+        return split_text(text, self.max_tokens)
+
+    def close(self):
+        # Only local models hold resources like threads and connections.
+        close = getattr(self.model, "close", None)
 
-    def analyse(self, text: str):
-        prompt = (
-            r"""You are a model that parses unstructured content from organizational charts into a provided json schema. Only provide the resulting json without any other text or comments. You should not add any additional data under any circumstance. If you can't find some information, leave the field to null. The "name" field after type usually consists of the previously found "type" and an additional identifier like numbers or letters. The contact field only consists of numbers. """
-            r"""Here is an example of a parsed entity: {"type":"Abteilung","name":"Abteilung V","persons":[{"name":"Schröder","positionType":"MD"}],"responsibilities":["Föderale Finanzbeziehungen","Staats- und Verfassungsrecht","Rechtsangelegenheiten","Historiker-Kommission"]} . """
-            f"The json schema looks like this: {self.schema} . "
-            f"And this is the provided content: {text}"
-        )
+        if close != None:
+            close()
 
+        self.usage.log()
+
+    @timed("llm_analyse_seconds")
+    def analyse(
+            self,
+            text: str,
+            deadline: Optional[Deadline] = None,
+            is_cancelled: Optional[Callable[[], bool]] = None):
+        """Returns the analysis of text by the LLM
+
+        A streamed response is abandoned with DeadlineExceeded as soon as a
+        chunk arrives after the deadline and with CancelledError as soon as
+        is_cancelled returns True.
+        """
+
+        prompt = self.prefix + text
         response = self.model.prompt(prompt, temperature=0)
 
-        response_text = response.text()
-        response_json = {}
+        # The response is consumed while it is generated, which lets the
+        # deadline and cancellation interrupt it between chunks. The analysis
+        # still needs the whole JSON value, only trailing text like comments
+        # or closing code fences is not waited for. Leaving the stream closes
+        # the request.
+        stream = iter(response)
+        json_stream = JsonStream()
+        response_text = None
+        response_json = None
 
         try:
-            response_json = json.loads(response_text, strict = False)
-        except Exception:
+            for chunk in stream:
+                if deadline != None:
+                    deadline.check("LLM request")
+
+                if is_cancelled != None and is_cancelled():
+                    raise CancelledError("LLM request cancelled")
+
+                response_text = json_stream.feed(chunk)
+
+                if response_text != None:
+                    break
+
             try:
-                response_json = json.loads(repair_json(response_text), strict = False)
+                if response_text == None:
+                    raise ValueError("incomplete JSON")
+
+                response_json = json.loads(response_text, strict = False)
             except Exception:
-                raise LlmResponseError(response_text)
+                response_text = json_stream.text() + "".join(stream)
 
-        response_values = collect_values(response_json)
+                try:
+                    response_json = json.loads(repair_json(response_text), strict = False)
+                except Exception:
+                    pass
+        finally:
+            close = getattr(stream, "close", None)
 
-        provided_content = text
-        response_content = " ".join(response_values)
+            if close != None:
+                close()
 
-        not_sorted = []
-        confabulated = []
+        (prompt_tokens, response_tokens) = count_tokens(response, prompt, response_text)
+        self.usage.add(prompt_tokens, response_tokens)
 
-        # collect content that hasn't been sorted by LLM
-        for word in provided_content.split():
-            if word not in response_content:
-                not_sorted.append(word)
+        logger.debug("LLM usage: %d prompt tokens, %d response tokens",
+                     prompt_tokens, response_tokens)
+
+        if response_json == None:
+            raise LlmResponseError(response_text)
+
+        response_json = self.validate(response_json)
+
+        if response_json is INVALID:
+            raise LlmResponseError(response_text)
+
+        # Dictionaries are used as ordered sets to report words in order.
+        response_words = {}
+
+        for value in collect_values(response_json):
+            response_words.update(dict.fromkeys(split_words(str(value))))
 
+        provided_words = split_words(text)
+        provided_set = set(provided_words)
+
+        # collect content that hasn't been sorted by LLM
+        not_sorted = [word for word in provided_words if word not in response_words]
         # collect content that has been added by LLM
-        for word in response_content.split():
-            if word not in provided_content:
-                confabulated.append(word)
+        confabulated = [word for word in response_words if word not in provided_set]
 
         response_json["error"] = {
             "uncategorized": not_sorted,
@@ -63,6 +150,45 @@ class SemanticAnalysis:
 
         return response_json
 
+class TokenUsage:
+    """Counts the tokens of all LLM requests of a SemanticAnalysis"""
+
+    __slots__ = ("lock", "requests", "prompt_tokens", "response_tokens")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+
+    def add(self, prompt_tokens: int, response_tokens: int):
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.response_tokens += response_tokens
+
+        metrics.count("llm_requests_total")
+        metrics.count("llm_prompt_tokens_total", prompt_tokens)
+        metrics.count("llm_response_tokens_total", response_tokens)
+
+    def log(self):
+        logger.info("LLM usage: %d requests, %d prompt tokens, %d response tokens",
+                    self.requests, self.prompt_tokens, self.response_tokens)
+
+def count_tokens(response, prompt: str, response_text: str) -> tuple[int, int]:
+    # Newer versions of llm report the usage of the provider, which is only
+    # available for some models and not if the stream was left early.
+    prompt_tokens = getattr(response, "input_tokens", None)
+    response_tokens = getattr(response, "output_tokens", None)
+
+    if prompt_tokens == None:
+        prompt_tokens = estimate_tokens(prompt)
+
+    if response_tokens == None:
+        response_tokens = estimate_tokens(response_text)
+
+    return (prompt_tokens, response_tokens)
+
 class LlmResponseError(Exception):
     response: str
 
@@ -70,6 +196,304 @@ class LlmResponseError(Exception):
         super().__init__(f"could not parse {repr(response)}")
         self.response = response
 
+class JsonStream:
+    """Finds where the first JSON object or array in streamed text ends
+
+    The text is scanned incrementally, so every character is only looked
+    at once regardless of the number of chunks. The value is not parsed
+    before it is complete.
+    """
+
+    __slots__ = ("chunks", "length", "start", "depth", "in_string", "escaped")
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.start = -1
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Returns the JSON text as soon as the top level value is closed"""
+
+        self.chunks.append(chunk)
+        offset = self.length
+        self.length += len(chunk)
+
+        for (i, c) in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                if 0 < self.depth:
+                    self.in_string = True
+            elif c == "{" or c == "[":
+                if self.depth == 0:
+                    self.start = offset + i
+                self.depth += 1
+            elif (c == "}" or c == "]") and 0 < self.depth:
+                self.depth -= 1
+
+                if self.depth == 0:
+                    return self.text()[self.start:offset + i + 1]
+
+        return None
+
+    def text(self) -> str:
+        """Returns all text fed so far"""
+
+        text = "".join(self.chunks)
+        self.chunks = [text]
+
+        return text
+
+# Punctuation glued to words in the text, which the LLM drops or adds freely.
+WORD_PUNCTUATION = ",;:()[]{}\"'„“”‚‘’«»"
+
+def split_words(text: str) -> list[str]:
+    """Splits text into words without surrounding punctuation
+
+    The words are compared as whole tokens, so that a word is not considered
+    present only because it is part of a longer word.
+    """
+
+    words = []
+
+    for word in text.split():
+        word = word.strip(WORD_PUNCTUATION)
+
+        if 0 < len(word):
+            words.append(word)
+
+    return words
+
+# Returned by a compiled schema for a value which cannot be trimmed to fit.
+INVALID = object()
+
+JSON_TYPES = {
+    "array": list,
+    "boolean": bool,
+    "integer": int,
+    "null": type(None),
+    "number": (int, float),
+    "object": dict,
+    "string": str,
+}
+
+def compile_schema(schema: dict) -> Callable[[Any], Any]:
+    """Compiles a JSON schema into a function validating a value in one pass
+
+    The function returns the value with invalid fields and items removed or
+    INVALID if the value itself does not fit. Only the subset of JSON schema
+    used by schema.json is supported: type, enum, properties, required,
+    additionalProperties and items. As the prompt asks the LLM to leave
+    unknown fields null, null is accepted for every property. A missing
+    required array defaults to an empty one, any other missing required
+    property makes the object INVALID, which drops it from its array.
+
+    Items given as a list are applied positionally and the last schema is
+    used for any further items, which covers the single item lists in
+    schema.json.
+    """
+
+    checks = []
+
+    schema_type = schema.get("type")
+    if schema_type != None:
+        types = [schema_type] if isinstance(schema_type, str) else schema_type
+        python_types = tuple(JSON_TYPES[t] for t in types)
+        allows_bool = "boolean" in types
+
+        def check_type(value):
+            if isinstance(value, bool) and not allows_bool:
+                return INVALID
+
+            return value if isinstance(value, python_types) else INVALID
+
+        checks.append(check_type)
+
+    enum = schema.get("enum")
+    if enum != None:
+        hashable = frozenset(v for v in enum if not isinstance(v, (dict, list)))
+
+        def check_enum(value):
+            if isinstance(value, (dict, list)):
+                return value if value in enum else INVALID
+
+            return value if value in hashable else INVALID
+
+        checks.append(check_enum)
+
+    properties = schema.get("properties")
+    required = schema.get("required", [])
+    additional = schema.get("additionalProperties", True)
+    if properties != None or 0 < len(required) or additional is not True:
+        validators = {key:compile_schema(value)
+                      for (key, value) in (properties or {}).items()}
+        additional_validator = None
+        # Required arrays are defaulted, e.g. the LLM leaves out persons for
+        # units without any.
+        defaults = [key for key in required
+                    if (properties or {}).get(key, {}).get("type") == "array"]
+
+        if isinstance(additional, dict):
+            additional_validator = compile_schema(additional)
+
+        def check_object(value):
+            if not isinstance(value, dict):
+                return value
+
+            result = {}
+
+            for (key, item) in value.items():
+                validator = validators.get(key, additional_validator)
+
+                if validator == None:
+                    if additional is False:
+                        continue
+                elif item is not None:
+                    item = validator(item)
+
+                    if item is INVALID:
+                        continue
+
+                result[key] = item
+
+            for key in required:
+                if result.get(key) != None:
+                    continue
+
+                if key in defaults:
+                    result[key] = []
+                elif key not in result:
+                    return INVALID
+
+            return result
+
+        checks.append(check_object)
+
+    items = schema.get("items")
+    if items != None:
+        if isinstance(items, dict):
+            item_validators = [compile_schema(items)]
+        else:
+            item_validators = [compile_schema(item) for item in items]
+
+        def check_array(value):
+            if not isinstance(value, list) or len(item_validators) == 0:
+                return value
+
+            result = []
+            last = len(item_validators) - 1
+
+            for (index, item) in enumerate(value):
+                item = item_validators[min(index, last)](item)
+
+                if item is not INVALID:
+                    result.append(item)
+
+            return result
+
+        checks.append(check_array)
+
+    def validate(value):
+        for check in checks:
+            value = check(value)
+
+            if value is INVALID:
+                break
+
+        return value
+
+    return validate
+
+def estimate_tokens(text: str) -> int:
+    # Tokenizers of common LLMs average about four characters per token. The
+    # estimate is good enough for a budget and avoids a tokenizer dependency.
+    return (len(text) + 3) // 4
+
+def split_text(text: str, max_tokens: int) -> list[str]:
+    """Splits text into chunks staying within the token budget
+
+    The text is split along the paragraphs (blank lines) emitted by
+    generate_text and consecutive paragraphs are packed into one chunk as
+    long as they fit. Paragraphs exceeding the budget alone are split along
+    their lines instead.
+    """
+
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    chunks = []
+
+    def pack(parts: list[str], separator: str):
+        chunk = ""
+
+        for part in parts:
+            if len(chunk) == 0:
+                chunk = part
+            elif estimate_tokens(chunk) + estimate_tokens(part) <= max_tokens:
+                chunk += separator + part
+            else:
+                chunks.append(chunk)
+                chunk = part
+
+        if 0 < len(chunk):
+            chunks.append(chunk)
+
+    paragraphs = []
+
+    for paragraph in text.split("\n\n"):
+        if max_tokens < estimate_tokens(paragraph):
+            if 0 < len(paragraphs):
+                pack(paragraphs, "\n\n")
+                paragraphs = []
+
+            pack(paragraph.split("\n"), "\n")
+        else:
+            paragraphs.append(paragraph)
+
+    pack(paragraphs, "\n\n")
+
+    return chunks
+
+def merge_analyses(analyses: list[dict]) -> dict:
+    """Merges the analyses of the chunks of one text into a single analysis
+
+    The first value found for a field wins, lists like persons and the
+    errors are concatenated in chunk order.
+    """
+
+    if len(analyses) == 1:
+        return analyses[0]
+
+    merged = {}
+    errors = {}
+
+    for analysis in analyses:
+        for (key, value) in analysis.items():
+            if key == "error":
+                for (error, words) in value.items():
+                    errors.setdefault(error, []).extend(words)
+            elif isinstance(value, list):
+                values = merged.get(key)
+
+                if values == None:
+                    merged[key] = list(value)
+                else:
+                    values.extend(value)
+            elif merged.get(key) == None:
+                merged[key] = value
+
+    merged["error"] = errors
+
+    return merged
+
 def collect_values(json, collected=None):
     if collected is None:
         collected = []